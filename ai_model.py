@@ -3,11 +3,18 @@ from dotenv import load_dotenv
 from google import genai
 from google.genai import types
 import streamlit as st
-from langfuse import get_client, observe
+from langfuse import get_client
 import ast
+import json
+import time
+from response_cache import ResponseCache, make_cache_key
+from answer_cache import answer_cache as default_answer_cache
+from conversation_context import estimate_tokens
+from schema_index import prune_schema
+from telemetry import record, record_usage, span, traced
 
 class GeminiModel:
-    def __init__(self, modelID="gemini-2.5-flash"):
+    def __init__(self, modelID="gemini-2.5-flash", response_cache=None, answer_cache=None):
         load_dotenv() 
         self.google_api_key = os.getenv("GOOGLE_API_KEY")
         self.langfuse_api_key = os.getenv("LANGFUSE_API_KEY")
@@ -18,9 +25,15 @@ class GeminiModel:
         if not self.langfuse_api_key:
             raise ValueError("LANGFUSE_API_KEY is not set in environment variables.")
         
-        self.client = genai.Client(api_key=self.google_api_key)
+        # GEMINI_BASE_URL points the client at another endpoint, e.g. a local fake server
+        base_url = os.getenv("GEMINI_BASE_URL")
+        http_options = types.HttpOptions(base_url=base_url) if base_url else None
+        self.client = genai.Client(api_key=self.google_api_key, http_options=http_options)
         langfuse = get_client()
         self.modelID = modelID
+        self.response_cache = response_cache if response_cache is not None else ResponseCache.from_env()
+        self.answer_cache = answer_cache if answer_cache is not None else default_answer_cache
+        self.last_schema_pruning = None
         self.safety_settings = [
             types.SafetySetting(
                 category="HARM_CATEGORY_DANGEROUS_CONTENT",
@@ -42,15 +55,26 @@ class GeminiModel:
 
 
     def check_prompt_safety(self, contents):
-        response = self.client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=contents,
-            config=types.GenerateContentConfig(
-                temperature=0,
-                max_output_tokens=1,
-                safety_settings=self.safety_settings,
+        key = make_cache_key("safety", "gemini-2.5-flash", contents, 0, 1)
+        return self.response_cache.get_or_call(key, 0, lambda: self._check_prompt_safety(contents))
+
+
+    def _check_prompt_safety(self, contents):
+        with span("gemini.safety_check", generation=True, model="gemini-2.5-flash"):
+            response = self.client.models.generate_content(
+                model="gemini-2.5-flash",
+                contents=contents,
+                config=types.GenerateContentConfig(
+                    temperature=0,
+                    max_output_tokens=1,
+                    safety_settings=self.safety_settings,
+                )
             )
-        )
+            record_usage(response)
+        return self._safety_categories(response)
+
+
+    def _safety_categories(self, response):
         safety_categories = []
         candidate = response.candidates[0]
         if candidate.finish_reason == types.FinishReason.SAFETY:
@@ -61,23 +85,31 @@ class GeminiModel:
         return safety_categories
 
 
-    @observe()
     def generate_response(self, contents, temperature=0.1, max_output_tokens=10000):
-        response = self.client.models.generate_content(
-            model=self.modelID,
-            contents=contents,
-            config=types.GenerateContentConfig(
-                temperature=temperature,
-                max_output_tokens=max_output_tokens,
-                safety_settings=self.safety_settings,
-            )
+        key = make_cache_key("response", self.modelID, contents, temperature, max_output_tokens)
+        return self.response_cache.get_or_call(
+            key, temperature, lambda: self._generate_response(contents, temperature, max_output_tokens)
         )
 
+
+    def _generate_response(self, contents, temperature, max_output_tokens):
+        with span("gemini.generate", generation=True, model=self.modelID):
+            response = self.client.models.generate_content(
+                model=self.modelID,
+                contents=contents,
+                config=types.GenerateContentConfig(
+                    temperature=temperature,
+                    max_output_tokens=max_output_tokens,
+                    safety_settings=self.safety_settings,
+                )
+            )
+            record_usage(response)
+
         return response.text
         
 
-    def generate_database(self, ddl_schema, prompt="", temperature=0.5, max_output_tokens=10000):
-        generate_database_prompt = [
+    def _database_prompt(self, ddl_schema, prompt):
+        return [
             "Generate a SQL database data based on the following DDL schema."
             "Include data types, null values, date and time formats, primary and foreign keys, unique, etc. "
             "Respond ONLY with the SQL INSERT statements. Do not include any explanation or commentary.",
@@ -86,9 +118,108 @@ class GeminiModel:
             "--- USER INSTRACTION/CONTEXT ---",  
             prompt                          
         ]
-        return self.generate_response(generate_database_prompt)
-        
-    
+
+
+    def generate_database(self, ddl_schema, prompt="", temperature=0.5, max_output_tokens=10000):
+        generate_database_prompt = self._database_prompt(ddl_schema, prompt)
+        return self.generate_response(generate_database_prompt, temperature=temperature, max_output_tokens=max_output_tokens)
+
+
+    def stream_database(self, ddl_schema, prompt="", temperature=0.5, max_output_tokens=10000):
+        # yields the response text chunk by chunk as the model produces it
+        contents = self._database_prompt(ddl_schema, prompt)
+        key = make_cache_key("response", self.modelID, contents, temperature, max_output_tokens)
+        return self.response_cache.stream_or_call(
+            key, temperature, lambda: self._stream_response(contents, temperature, max_output_tokens)
+        )
+
+
+    def _stream_response(self, contents, temperature, max_output_tokens):
+        # only the time spent waiting on the model is measured; the span is opened after the stream ends,
+        # held open across the yields it would become the parent of every span the caller opens meanwhile
+        waited = 0.0
+        chunks = 0
+        chunk = None
+        error = None
+        try:
+            fetch_start = time.perf_counter()
+            stream = iter(self.client.models.generate_content_stream(
+                model=self.modelID,
+                contents=contents,
+                config=types.GenerateContentConfig(
+                    temperature=temperature,
+                    max_output_tokens=max_output_tokens,
+                    safety_settings=self.safety_settings,
+                )
+            ))
+            for chunk in stream:
+                waited += time.perf_counter() - fetch_start
+                chunks += 1
+                if chunk.text:
+                    yield chunk.text
+                fetch_start = time.perf_counter()
+            waited += time.perf_counter() - fetch_start
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            with span("gemini.generate_stream", generation=True, model=self.modelID, chunks=chunks) as current:
+                current.start = time.perf_counter() - waited
+                if error:
+                    current.set(error=error)
+                # the last chunk carries the usage of the whole response
+                if chunk is not None:
+                    record_usage(chunk)
+
+
+    def generate_table_data(self, table_ddl, table_name, parent_keys=None, null_columns=None, prompt="", temperature=0.5, max_output_tokens=10000,
+                            used_keys=None, row_count=None, rejected=None):
+        contents = [
+            f"Generate SQL data for the table {table_name} based on the following DDL."
+            + (f" Generate exactly {row_count} rows." if row_count else ""),
+            "Include data types, null values, date and time formats, primary keys, unique values, etc. "
+            f"Respond ONLY with SQL INSERT statements into {table_name}. Do not include any explanation or commentary.",
+            "--- DDL SCHEMA ---",
+            table_ddl,
+        ]
+        if parent_keys:
+            contents.append("--- EXISTING FOREIGN KEY VALUES (use ONLY these values for the foreign key columns) ---")
+            for column, values in parent_keys.items():
+                contents.append(f"{column}: {', '.join(str(value) for value in values)}")
+        if null_columns:
+            contents.append(f"Set these columns to NULL, they are filled later: {', '.join(null_columns)}")
+        if used_keys:
+            contents.append("--- VALUES ALREADY IN THE TABLE (do NOT repeat them in these columns) ---")
+            for columns, values in used_keys.items():
+                contents.append(f"{columns}: {', '.join(str(value) for value in values)}")
+        if rejected:
+            contents.append("--- PREVIOUS ROWS WERE REJECTED BY (rows) ---")
+            contents.extend(f"{reason}: {rows}" for reason, rows in rejected.items())
+        contents.extend(["--- USER INSTRACTION/CONTEXT ---", prompt])
+        return self.generate_response(contents, temperature=temperature, max_output_tokens=max_output_tokens)
+
+
+    def suggest_column_distributions(self, ddl_schema):
+        contents = [
+            "Suggest realistic value distributions for the columns of the following DDL schema.",
+            "Respond ONLY with a JSON object in the format {table_name: {column_name: distribution}} using lower case names.",
+            "A distribution is one of:",
+            '{"type": "normal", "mean": number, "std": number, "min": number, "max": number}',
+            '{"type": "uniform", "min": number, "max": number}',
+            '{"type": "lognormal", "mean": number, "sigma": number}',
+            '{"values": [list of values], "weights": [list of relative weights]}',
+            'Any distribution may also contain "null_fraction" (0-1) for nullable columns or "true_fraction" for booleans.',
+            "Skip primary keys, foreign keys and columns without an obvious distribution. Do not include any explanation or commentary.",
+            "--- DDL SCHEMA ---",
+            ddl_schema,
+        ]
+        response = self.generate_response(contents, temperature=0)
+        try:
+            return json.loads(response.strip().removeprefix("```json").removeprefix("```").removesuffix("```"))
+        except (json.JSONDecodeError, AttributeError):
+            print(f"Unable to parse suggested distributions: {response}")
+            return {}
+
 
     def extract_important_info_from_edit_prompt(self, user_instructions):
         contents = [
@@ -113,7 +244,55 @@ class GeminiModel:
             return "INSUFFICIENT INFORMATION: Unable to parse the response. " + response.text
     
 
-    def generate_answer(self, ddl_schema, query, context):
+    def extract_edit_plan(self, user_instructions, schema_summary):
+        contents = [
+            "Used to turn user instructions for editing database rows into a structured edit plan.",
+            "--- TABLES (name: primary key; columns) ---",
+            schema_summary,
+            "User instructions: ",
+            user_instructions,
+            "Respond ONLY with a JSON object in the format {\"operations\": [operation, ...]}.",
+            "Each operation has \"table\" and exactly one row selector:",
+            "  \"row_ids\": [list of primary key values],",
+            "  \"row_range\": [first primary key, last primary key] (inclusive),",
+            "  \"filters\": {column: value} (rows where every column equals the value),",
+            "  \"rows\": [{\"id\": primary key, \"values\": {column: new value}}] when every row gets different values.",
+            "Unless \"rows\" is used, the operation also has \"values\": {column: new value}, where a new value is either",
+            "a literal or {\"op\": \"multiply\" | \"add\", \"value\": number} to change a numeric column relative to its current value.",
+            "If the table, the rows or the new values are missing, respond with 'INSUFFICIENT INFORMATION' and write which elements are missing.",
+            "Do not include any explanation or commentary.",
+        ]
+
+        response = self.generate_response(contents, temperature=0)
+
+        try:
+            plan = json.loads(response.strip().removeprefix("```json").removeprefix("```").removesuffix("```"))
+            if isinstance(plan, dict) and isinstance(plan.get("operations"), list) and plan["operations"]:
+                return plan
+            return "INSUFFICIENT INFORMATION: Response is not a valid edit plan. " + response
+        except (json.JSONDecodeError, AttributeError):
+            return "INSUFFICIENT INFORMATION: Unable to parse the response. " + str(response)
+
+
+    @traced("generate_answer")
+    def generate_answer(self, ddl_schema, query, context, ddl_hash=None, previous_question=None):
+        cached_answer = self.answer_cache.get(ddl_hash, query, previous_question)
+        if cached_answer is not None:
+            print(f"Answer cache hit (hit ratio: {self.answer_cache.hit_ratio():.0%})")
+            record(answer_cache_hits=1)
+            return cached_answer
+
+        contents = self._answer_prompt(ddl_schema, query, context, ddl_hash)
+        response = self.generate_response(contents)
+        return self._parse_answer(response, query, ddl_hash, previous_question)
+
+
+    def _answer_prompt(self, ddl_schema, query, context, ddl_hash=None):
+        # only the tables relevant to the question go into the prompt
+        ddl_schema, self.last_schema_pruning = prune_schema(ddl_schema, query, ddl_hash)
+        if self.last_schema_pruning:
+            record(schema_tokens_saved=self.last_schema_pruning["tokens_saved"])
+
         contents = contents = f"""
             You are an assistant that decides whether the user's request requires DATA or a PLOT. 
             You also generate SQL to retrieve the data. 
@@ -176,8 +355,15 @@ class GeminiModel:
             {query}
             """
 
-        response = self.generate_response(contents)
+        print(f"generate_answer prompt: ~{estimate_tokens(contents)} tokens")
+        return contents
+
+
+    def _parse_answer(self, response, query, ddl_hash=None, previous_question=None):
         print(response)
         if response[2] or response[3]:
-            return ast.literal_eval(response)           
+            answer = ast.literal_eval(response)
+            if isinstance(answer, tuple) and len(answer) == 4 and answer[0] in ('DATA', 'PLOT'):
+                self.answer_cache.set(ddl_hash, query, answer, previous_question)
+            return answer
         return response[1]     
\ No newline at end of file
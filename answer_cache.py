@@ -0,0 +1,80 @@
+import re
+import threading
+from collections import OrderedDict
+
+
+# words that do not change which SQL answers a question ("not", "no", "top", ... are kept on purpose)
+STOP_WORDS = {
+    "a", "an", "the", "of", "in", "on", "at", "to", "for", "by", "with", "from", "and",
+    "is", "are", "was", "were", "be", "been", "do", "does", "did", "there", "here",
+    "me", "my", "i", "we", "our", "you", "your", "please", "can", "could", "would",
+    "show", "give", "tell", "list", "display", "get", "find", "what", "which", "whats",
+    "that", "this", "these", "those", "it", "its", "all", "each", "per", "every",
+}
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+# "and per city?", "what about last year?" only mean something together with the question before them
+_FOLLOW_UP = re.compile(r"^\s*(and|or|but|also|now|then|instead|same|what about|how about)\b", re.I)
+
+
+def normalize_question(question):
+    # case, punctuation, whitespace and stop words are ignored, the order of the other words is kept
+    text = _PUNCTUATION.sub(" ", question.lower())
+    words = [word for word in text.split() if word not in STOP_WORDS]
+    return " ".join(words)
+
+
+def is_follow_up(question):
+    return _FOLLOW_UP.match(question) is not None
+
+
+class AnswerCache:
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, ddl_hash, question, previous_question):
+        # a follow-up is keyed together with the previous question, anything else stands on its own
+        previous = normalize_question(previous_question) if previous_question and is_follow_up(question) else None
+        return (ddl_hash, normalize_question(question), previous)
+
+    def get(self, ddl_hash, question, previous_question=None):
+        if ddl_hash is None:
+            return None
+        key = self._key(ddl_hash, question, previous_question)
+        with self._lock:
+            answer = self._entries.get(key)
+            if answer is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return answer
+
+    def set(self, ddl_hash, question, answer, previous_question=None):
+        if ddl_hash is None:
+            return
+        key = self._key(ddl_hash, question, previous_question)
+        with self._lock:
+            self._entries[key] = tuple(answer)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._entries),
+            "hit_ratio": self.hit_ratio(),
+        }
+
+
+answer_cache = AnswerCache()
@@ -1,21 +1,47 @@
+import sys
+import time
+
+# Streamlit runs this script again on every interaction; only the first run in a process imports anything
+run_start = time.perf_counter()
+cold_start = "view_side_bar" not in sys.modules
+
 import streamlit as st
-from ai_model import GeminiModel
+from telemetry import span, write_metrics
 from view_side_bar import show_side_bar
-from view_data_generation import view_data_generation_foo
-from view_talk_to_your_data import view_talk_to_your_data_foo
+
+import_seconds = time.perf_counter() - run_start
 
 
-script = None
-tables = None
-model = GeminiModel()
+@st.cache_resource
+def get_model():
+    # one model per process: the genai client, the Langfuse client and the caches are shared by every rerun
+    # and session; google-genai and langfuse are only imported when a page first needs the model
+    from async_ai_model import AsyncGeminiModel
+    return AsyncGeminiModel()
+
 
 if "page" not in st.session_state:
     st.session_state.page = "Data Generation"
 
 show_side_bar()
 
-if st.session_state.page == 'Data Generation':
-    view_data_generation_foo(model)
-elif st.session_state.page == 'Talk to your data': 
-    view_talk_to_your_data_foo(model)
-
+# first render and rerun cost end up in the local stage metrics, not in Langfuse
+with span("app.first_render" if cold_start else "app.rerun", langfuse=False, page=st.session_state.page) as run:
+    if cold_start:
+        run.set(import_seconds=round(import_seconds, 3))
+    try:
+        if "session_schema" in st.session_state:
+            # keeps the session's Postgres schema from being collected as idle
+            from session_database import keep_session_schema_alive
+            keep_session_schema_alive(st.session_state)
+        if st.session_state.page == 'Data Generation':
+            from view_data_generation import view_data_generation_foo
+            view_data_generation_foo(get_model)
+        elif st.session_state.page == 'Talk to your data':
+            # pulls in the plot renderer and message store, the Data Generation page does not need them
+            from view_talk_to_your_data import view_talk_to_your_data_foo
+            view_talk_to_your_data_foo(get_model)
+    finally:
+        if cold_start:
+            print(f"Cold start: imports {import_seconds:.2f}s, first render {time.perf_counter() - run_start:.2f}s")
+            write_metrics()
@@ -0,0 +1,196 @@
+import asyncio
+import contextvars
+import os
+import random
+import threading
+import time
+from google.genai import errors, types
+from ai_model import GeminiModel
+from response_cache import make_cache_key
+from telemetry import record, record_usage, span, traced
+
+
+GEMINI_RATE_PER_SECOND = float(os.getenv("GEMINI_RATE_PER_SECOND", "2"))
+GEMINI_BURST = int(os.getenv("GEMINI_BURST", "5"))
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "60"))
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "4"))
+GEMINI_BACKOFF_BASE = 0.5
+GEMINI_BACKOFF_MAX = 20.0
+
+
+class TokenBucket:
+    # shared by every model instance, which may run on different event loops and threads, so the state is guarded by a thread lock
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        # takes a token now and returns how long to wait for it; waiting callers queue up behind each other
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    async def acquire(self):
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+
+# shared by every session of the app process
+rate_limiter = TokenBucket(GEMINI_RATE_PER_SECOND, GEMINI_BURST)
+
+
+async def _in_context(context, coroutine):
+    # the task runs on the loop thread; the caller's context variables (the current trace and span) go with it
+    for variable, value in context.items():
+        variable.set(value)
+    return await coroutine
+
+
+class EventLoopThread:
+    # one event loop for the process in a daemon thread. the genai aio client keeps an httpx connection pool
+    # bound to the loop it was first used on, so every async call of the cached model has to run on this loop;
+    # a new asyncio.run loop per question would reuse connections of the previous, closed loop
+    def __init__(self, name="gemini-event-loop"):
+        self.name = name
+        self.loop = None
+        self._lock = threading.Lock()
+
+    def _get_loop(self):
+        with self._lock:
+            if self.loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name=self.name, daemon=True).start()
+                self.loop = loop
+            return self.loop
+
+    def run(self, coroutine):
+        # blocks the calling thread until the coroutine is done and returns its result
+        context = contextvars.copy_context()
+        return asyncio.run_coroutine_threadsafe(_in_context(context, coroutine), self._get_loop()).result()
+
+
+event_loop = EventLoopThread()
+
+
+def is_retryable(error):
+    if isinstance(error, asyncio.TimeoutError):
+        return True
+    if isinstance(error, errors.APIError):
+        return error.code == 429 or (error.code or 0) >= 500
+    return False
+
+
+def backoff_delay(attempt, base=GEMINI_BACKOFF_BASE, max_delay=GEMINI_BACKOFF_MAX):
+    # exponential backoff with full jitter
+    return random.uniform(0, min(max_delay, base * 2 ** attempt))
+
+
+async def call_with_retries(call, limiter=rate_limiter, timeout=GEMINI_TIMEOUT, max_retries=GEMINI_MAX_RETRIES):
+    for attempt in range(max_retries + 1):
+        await limiter.acquire()
+        try:
+            return await asyncio.wait_for(call(), timeout)
+        except Exception as e:
+            if attempt == max_retries or not is_retryable(e):
+                raise
+            delay = backoff_delay(attempt)
+            record(retries=1)
+            print(f"Gemini call failed ({type(e).__name__}: {e}), retrying in {delay:.2f}s "
+                  f"(attempt {attempt + 1}/{max_retries})")
+            await asyncio.sleep(delay)
+
+
+class AsyncGeminiModel(GeminiModel):
+    def __init__(self, modelID="gemini-2.5-flash", response_cache=None, answer_cache=None,
+                 limiter=None, timeout=GEMINI_TIMEOUT, max_retries=GEMINI_MAX_RETRIES):
+        super().__init__(modelID, response_cache=response_cache, answer_cache=answer_cache)
+        self.limiter = limiter if limiter is not None else rate_limiter
+        self.timeout = timeout
+        self.max_retries = max_retries
+
+
+    def run(self, coroutine):
+        # entry point for synchronous callers (the Streamlit script thread)
+        return event_loop.run(coroutine)
+
+
+    async def _call(self, call):
+        return await call_with_retries(call, self.limiter, self.timeout, self.max_retries)
+
+
+    async def acheck_prompt_safety(self, contents):
+        key = make_cache_key("safety", "gemini-2.5-flash", contents, 0, 1)
+        return await self.response_cache.aget_or_call(key, 0, lambda: self._acheck_prompt_safety(contents))
+
+
+    async def _acheck_prompt_safety(self, contents):
+        with span("gemini.safety_check", generation=True, model="gemini-2.5-flash"):
+            response = await self._call(lambda: self.client.aio.models.generate_content(
+                model="gemini-2.5-flash",
+                contents=contents,
+                config=types.GenerateContentConfig(
+                    temperature=0,
+                    max_output_tokens=1,
+                    safety_settings=self.safety_settings,
+                )
+            ))
+            record_usage(response)
+        return self._safety_categories(response)
+
+
+    async def agenerate_response(self, contents, temperature=0.1, max_output_tokens=10000):
+        key = make_cache_key("response", self.modelID, contents, temperature, max_output_tokens)
+        return await self.response_cache.aget_or_call(
+            key, temperature, lambda: self._agenerate_response(contents, temperature, max_output_tokens)
+        )
+
+
+    async def _agenerate_response(self, contents, temperature, max_output_tokens):
+        with span("gemini.generate", generation=True, model=self.modelID):
+            response = await self._call(lambda: self.client.aio.models.generate_content(
+                model=self.modelID,
+                contents=contents,
+                config=types.GenerateContentConfig(
+                    temperature=temperature,
+                    max_output_tokens=max_output_tokens,
+                    safety_settings=self.safety_settings,
+                )
+            ))
+            record_usage(response)
+        return response.text
+
+
+    @traced("generate_answer")
+    async def agenerate_answer(self, ddl_schema, query, context, ddl_hash=None, previous_question=None):
+        cached_answer = self.answer_cache.get(ddl_hash, query, previous_question)
+        if cached_answer is not None:
+            print(f"Answer cache hit (hit ratio: {self.answer_cache.hit_ratio():.0%})")
+            record(answer_cache_hits=1)
+            return cached_answer
+
+        contents = self._answer_prompt(ddl_schema, query, context, ddl_hash)
+        response = await self.agenerate_response(contents)
+        return self._parse_answer(response, query, ddl_hash, previous_question)
+
+
+    async def answer_safely(self, ddl_schema, query, context, ddl_hash=None, previous_question=None):
+        # the safety check and the answer run concurrently; the answer is cancelled if the prompt is blocked.
+        # returns (safety categories, answer or None)
+        answer_task = asyncio.create_task(self.agenerate_answer(ddl_schema, query, context, ddl_hash, previous_question))
+        try:
+            safety_categories = await self.acheck_prompt_safety(query)
+        except BaseException:
+            answer_task.cancel()
+            raise
+        if safety_categories:
+            answer_task.cancel()
+            return safety_categories, None
+        return [], await answer_task
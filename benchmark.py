@@ -0,0 +1,376 @@
+import argparse
+import datetime
+import decimal
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+import numpy as np
+import pandas as pd
+import streamlit as st
+import databse_operations
+from databse_operations import add_data_to_database, create_database, execute_given_sql_statement, fetch_result_page
+from data_export import export_tables
+from ddl_parser import parse_ddl, quote_identifier
+from schema_catalog import compute_ddl_hash
+from result_cache import result_cache
+from session_database import create_app_engine
+from synthetic_data import SyntheticDataEngine, parse_check_bounds
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+BENCHMARK_DDL_FILES = ["company_employee_schema.ddl", "library_mgm_schema.ddl", "restrurants_schema.ddl"]
+BENCHMARK_SCALES = [10, 100, 1000]
+BENCHMARK_REPEAT = 5
+RSS_SAMPLE_SECONDS = 0.01
+# runs app.py headless in a fresh interpreter: the first run is the cold start, the second a rerun after a click
+STARTUP_PROBE = """
+import json, time
+from streamlit.testing.v1 import AppTest
+app = AppTest.from_file("app.py", default_timeout=120)
+start = time.perf_counter()
+app.run()
+first_render = time.perf_counter() - start
+start = time.perf_counter()
+app.run()
+print(json.dumps({"first_render": first_render, "rerun": time.perf_counter() - start}))
+"""
+
+
+def _sql_literal(value):
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return "NULL"
+    if isinstance(value, (bool, np.bool_)):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, (int, float, decimal.Decimal, np.integer, np.floating)):
+        return str(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+class FakeGeminiModel:
+    # deterministic stand-in for GeminiModel: recorded responses are replayed after a fixed latency,
+    # generated data is rendered as INSERT statements from the local synthetic engine
+    def __init__(self, rows_per_table, latency=0.0, seed=0, recordings=None):
+        self.rows_per_table = rows_per_table
+        self.latency = latency
+        self.seed = seed
+        self.recordings = recordings or {}
+        self.calls = 0
+
+    def _respond(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def check_prompt_safety(self, contents):
+        self._respond()
+        return []
+
+    def generate_database(self, ddl_schema, prompt="", temperature=0.5, max_output_tokens=10000):
+        self._respond()
+        recorded = self.recordings.get(compute_ddl_hash(ddl_schema), {}).get("generate_database")
+        return recorded if recorded is not None else self.render_inserts(ddl_schema)
+
+    def generate_answer(self, ddl_schema, query, context, ddl_hash=None):
+        self._respond()
+        return tuple(self.recordings[ddl_hash or compute_ddl_hash(ddl_schema)]["answers"][query])
+
+    def render_inserts(self, ddl_schema):
+        # generated keys are 1..rows, so foreign keys are drawn from that range without touching the database
+        generator = SyntheticDataEngine(ddl_schema, None, seed=self.seed)
+        for table in generator.schema.tables.values():
+            key = generator._integer_key(table)
+            if key is not None:
+                generator.key_ranges[(table.name, key)] = (1, self.rows_per_table)
+
+        statements = []
+        for level in generator.levels:
+            for table_name in level:
+                table = generator.schema.tables[table_name]
+                bounds = parse_check_bounds(table.checks)
+                row_index = np.arange(1, self.rows_per_table + 1, dtype=np.int64)
+                columns = {
+                    name: generator.generate_column(None, table, column, self.rows_per_table, row_index, generator.rng, bounds)
+                    for name, column in table.columns.items()
+                }
+                column_sql = ", ".join(quote_identifier(name) for name in columns)
+                rows = zip(*(np.asarray(values, dtype=object) for values in columns.values()))
+                values_sql = ",\n".join("(" + ", ".join(_sql_literal(value) for value in row) + ")" for row in rows)
+                statements.append(f"INSERT INTO {quote_identifier(table_name)} ({column_sql}) VALUES\n{values_sql};")
+        return "\n".join(statements)
+
+
+def default_workload(ddl_schema):
+    # recorded (question -> answer tuple) pairs built from the schema: a count, a page of the
+    # biggest table, a join aggregate and a plot of the same aggregate
+    schema = parse_ddl(ddl_schema)
+    answers = {}
+    tables = list(schema.tables.values())
+    first = tables[0]
+    answers[f"How many rows are in {first.name}?"] = (
+        "DATA", "Row count.", f"SELECT COUNT(*) AS row_count FROM {quote_identifier(first.name)}", None
+    )
+    widest = max(tables, key=lambda table: len(table.columns))
+    answers[f"Show all {widest.name}"] = ("DATA", "All rows.", f"SELECT * FROM {quote_identifier(widest.name)}", None)
+    for child in tables:
+        for foreign_key in child.foreign_keys:
+            parent = schema.tables.get(foreign_key.ref_table)
+            if parent is None or len(foreign_key.columns) != 1:
+                continue
+            ref_column = (foreign_key.ref_columns or parent.primary_key)[0]
+            sql = (
+                f"SELECT p.{quote_identifier(ref_column)} AS parent_key, COUNT(*) AS children "
+                f"FROM {quote_identifier(child.name)} c JOIN {quote_identifier(parent.name)} p "
+                f"ON c.{quote_identifier(foreign_key.columns[0])} = p.{quote_identifier(ref_column)} "
+                f"GROUP BY p.{quote_identifier(ref_column)} ORDER BY children DESC LIMIT 20"
+            )
+            answers[f"How many {child.name} per {parent.name}?"] = ("DATA", "Children per parent.", sql, None)
+            plot_code = (
+                "import seaborn as sns\nimport matplotlib.pyplot as plt\nplt.figure(figsize=(8, 4))\n"
+                "sns.barplot(data=df, x='parent_key', y='children')\nplt.xticks(rotation=45)"
+            )
+            answers[f"Plot {child.name} per {parent.name}"] = ("PLOT", "Children per parent.", sql, plot_code)
+            return answers
+    return answers
+
+
+class RssSampler:
+    # peak resident memory of this process (and the plot workers) while a stage runs
+    def __init__(self):
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _rss(self):
+        if psutil is None:
+            import resource
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        process = psutil.Process()
+        rss = process.memory_info().rss
+        for child in process.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except psutil.Error:
+                pass
+        return rss
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self._rss())
+            self._stop.wait(RSS_SAMPLE_SECONDS)
+
+    def __enter__(self):
+        self.peak = self._rss()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self._rss())
+
+
+class StageRecorder:
+    def __init__(self):
+        self.results = []
+
+    def measure(self, ddl_file, scale, stage, repeat, run, unit="ops"):
+        # run() returns the amount of work done (rows, bytes, ...) used for the throughput
+        durations = []
+        work = 0
+        with RssSampler() as sampler:
+            for _ in range(repeat):
+                start = time.perf_counter()
+                work += run() or 1
+                durations.append(time.perf_counter() - start)
+        return self.add(ddl_file, scale, stage, durations, work, unit, sampler.peak)
+
+    def add(self, ddl_file, scale, stage, durations, work, unit, peak_rss):
+        total = sum(durations)
+        result = {
+            "ddl": ddl_file,
+            "scale": scale,
+            "stage": stage,
+            "count": len(durations),
+            "p50_ms": float(np.percentile(durations, 50) * 1000),
+            "p95_ms": float(np.percentile(durations, 95) * 1000),
+            "mean_ms": total / len(durations) * 1000,
+            "throughput": work / total if total else 0.0,
+            "throughput_unit": f"{unit}/s",
+            "peak_rss_mb": peak_rss / 1024 / 1024,
+        }
+        self.results.append(result)
+        print(f"{ddl_file} x{scale} {stage}: p50 {result['p50_ms']:.1f} ms, p95 {result['p95_ms']:.1f} ms, "
+              f"{result['throughput']:,.0f} {unit}/s, peak RSS {result['peak_rss_mb']:.0f} MB", file=sys.stderr)
+        return result
+
+
+def benchmark_schema(recorder, ddl_file, ddl_schema, scale, repeat, latency, recordings):
+    from view_talk_to_your_data import execute_seaborn_code
+    from plot_renderer import plot_renderer
+
+    ddl_hash = compute_ddl_hash(ddl_schema)
+    recordings.setdefault(ddl_hash, {}).setdefault("answers", default_workload(ddl_schema))
+    model = FakeGeminiModel(scale, latency=latency, recordings=recordings)
+    # st.session_state works outside a Streamlit run (bare mode), the code paths read it directly
+    session_state = st.session_state
+    session_state.update({"engine": None, "last_ddl_hash": ddl_hash})
+
+    def create():
+        # every run starts from empty tables
+        session_state.update(create_database(ddl_schema, mode="recreate"))
+
+    def generate_and_insert():
+        create()
+        report = add_data_to_database(model.generate_database(ddl_schema), session_state)
+        return report.inserted_rows
+
+    recorder.measure(ddl_file, scale, "create_database", repeat, create)
+    recorder.measure(ddl_file, scale, "generate_and_insert", repeat, generate_and_insert, unit="rows")
+
+    answers = recordings[ddl_hash]["answers"]
+    for question, answer in answers.items():
+        result_type, _, sql_query, python_code = answer
+
+        def ask(cached=False):
+            model.check_prompt_safety(question)
+            model.generate_answer(ddl_schema, question, "", ddl_hash)
+            if not cached:
+                # measure the database work, not the result cache
+                result_cache.clear()
+            if result_type == "PLOT":
+                df = execute_given_sql_statement(sql_query)
+                # measure the rendering itself, not the image cache
+                plot_renderer.cache.clear()
+                return len(execute_seaborn_code(python_code, df))
+            df, _ = fetch_result_page(sql_query)
+            return len(df)
+
+        stage = "plot" if result_type == "PLOT" else "query"
+        if stage == "plot":
+            # start the worker processes outside the measurement
+            ask()
+        recorder.measure(ddl_file, scale, f"{stage}: {question}", repeat, ask, unit="bytes" if stage == "plot" else "rows")
+        if stage == "query":
+            recorder.measure(ddl_file, scale, f"cached query: {question}", repeat, lambda: ask(cached=True), unit="rows")
+
+    tables = list(parse_ddl(ddl_schema).tables)
+    for export_format in ("CSV", "Parquet (ZIP)"):
+        def export():
+            path = export_tables(databse_operations.engine, tables, export_format)
+            size = os.path.getsize(path)
+            os.remove(path)
+            return size
+
+        recorder.measure(ddl_file, scale, f"export: {export_format}", repeat, export, unit="bytes")
+
+
+def benchmark_startup(recorder, repeat):
+    timings = []
+    with RssSampler() as sampler:
+        for _ in range(repeat):
+            output = subprocess.run([sys.executable, "-c", STARTUP_PROBE], capture_output=True, text=True, check=True,
+                                    cwd=os.path.dirname(os.path.abspath(__file__)))
+            timings.append(json.loads(output.stdout.strip().splitlines()[-1]))
+    for stage in ("first_render", "rerun"):
+        recorder.add("app.py", None, f"app: {stage}", [timing[stage] for timing in timings], repeat, "runs", sampler.peak)
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {(r["ddl"], r["scale"], r["stage"]): r for r in json.load(f)["results"]}
+    for result in results:
+        previous = baseline.get((result["ddl"], result["scale"], result["stage"]))
+        if previous and previous["p50_ms"]:
+            change = result["p50_ms"] / previous["p50_ms"] - 1
+            print(f"{result['ddl']} x{result['scale']} {result['stage']}: p50 {change:+.0%}", file=sys.stderr)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _embedded_database_url():
+    # pgserver runs a throwaway Postgres when no database is given
+    try:
+        import pgserver
+    except ImportError:
+        sys.exit("pgserver is not installed: pip install pgserver, or pass --database-url (BENCHMARK_DATABASE_URL).")
+    import tempfile
+
+    server = pgserver.get_server(tempfile.mkdtemp(prefix="talk_with_database_benchmark_"), cleanup_mode="stop")
+    return server.get_uri().replace("postgresql://", "postgresql+psycopg2://"), server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark of data generation, querying, plotting and exports.")
+    parser.add_argument("--database-url", default=os.getenv("BENCHMARK_DATABASE_URL"),
+                        help="Postgres to run against; its public schema is dropped and recreated. "
+                             "Defaults to an embedded pgserver instance.")
+    parser.add_argument("--ddl", nargs="+", default=BENCHMARK_DDL_FILES)
+    parser.add_argument("--scales", default=",".join(map(str, BENCHMARK_SCALES)), help="Rows per table, comma separated.")
+    parser.add_argument("--repeat", type=int, default=BENCHMARK_REPEAT)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Simulated model latency per call.")
+    parser.add_argument("--recordings", help="JSON file with recorded responses {ddl_hash: {generate_database, answers}}.")
+    parser.add_argument("--output", help="Write the JSON results to this file instead of stdout.")
+    parser.add_argument("--compare", help="Previous results file to compare p50 latencies with.")
+    parser.add_argument("--skip-startup", action="store_true", help="Do not measure the cold start of app.py.")
+    args = parser.parse_args(argv)
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+    server = None
+    database_url = args.database_url
+    if not database_url:
+        database_url, server = _embedded_database_url()
+    databse_operations.engine = create_app_engine(database_url)
+
+    recordings = {}
+    if args.recordings:
+        with open(args.recordings) as f:
+            recordings = json.load(f)
+
+    recorder = StageRecorder()
+    if not args.skip_startup:
+        benchmark_startup(recorder, args.repeat)
+    for scale in [int(scale) for scale in args.scales.split(",")]:
+        for ddl_file in args.ddl:
+            with open(ddl_file) as f:
+                ddl_schema = f.read()
+            benchmark_schema(recorder, os.path.basename(ddl_file), ddl_schema, scale, args.repeat,
+                             args.latency_ms / 1000, recordings)
+
+    output = {
+        "commit": _git_commit(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {"scales": args.scales, "repeat": args.repeat, "latency_ms": args.latency_ms, "ddl": args.ddl},
+        "results": recorder.results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+    else:
+        print(json.dumps(output, indent=2))
+    if args.compare:
+        compare(recorder.results, args.compare)
+
+    databse_operations.engine.dispose()
+    if server is not None:
+        server.cleanup()
+
+
+if __name__ == "__main__":
+    main()
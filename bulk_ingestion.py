@@ -0,0 +1,362 @@
+import datetime
+import decimal
+import io
+import os
+import re
+import time
+import psycopg2
+from psycopg2.extras import execute_values
+from sqlalchemy import inspect
+from sqlalchemy.exc import NoSuchTableError
+from sqlalchemy.types import Integer, Float, Numeric, Boolean, Date, DateTime, Time
+from ddl_parser import normalize_identifier, quote_identifier, split_sql_statements, split_top_level
+from read_cache import read_cache
+
+
+INGESTION_METHOD = os.getenv("INGESTION_METHOD", "copy")
+INGESTION_BATCH_SIZE = int(os.getenv("INGESTION_BATCH_SIZE", "1000"))
+
+_DEFAULT = object()
+_INSERT_PATTERN = re.compile(
+    r"INSERT\s+INTO\s+(\"[^\"]+\"|[\w.]+)\s*(?:\(([^)]*)\))?\s*VALUES\s*(.*)$", re.I | re.S
+)
+_NUMBER_PATTERN = re.compile(r"^[+-]?(\d+(\.\d*)?|\.\d+)([eE][+-]?\d+)?$")
+_TYPED_LITERAL_PATTERN = re.compile(r"^(DATE|TIMESTAMP|TIME|TIMESTAMPTZ)\s+('.*')$", re.I | re.S)
+_TRUE_VALUES = {"t", "true", "y", "yes", "on", "1"}
+_FALSE_VALUES = {"f", "false", "n", "no", "off", "0"}
+
+
+class UnsupportedStatement(ValueError):
+    pass
+
+
+class InsertBatch:
+    def __init__(self, table, columns):
+        self.table = table
+        self.columns = columns
+        self.rows = []
+
+
+class RawStatement:
+    def __init__(self, statement, table=None):
+        self.statement = statement
+        self.table = table
+
+
+class IngestionReport:
+    def __init__(self):
+        self.tables = {}
+        self.failures = []
+
+    def _table(self, table):
+        return self.tables.setdefault(table, {"rows": 0, "failed": 0, "seconds": 0.0})
+
+    def add_rows(self, table, rows, seconds):
+        stats = self._table(table)
+        stats["rows"] += rows
+        stats["seconds"] += seconds
+
+    def add_failure(self, table, row, error, constraint=None):
+        self._table(table)["failed"] += 1
+        self.failures.append({"table": table, "row": row, "error": str(error).strip(), "constraint": constraint})
+
+    def merge(self, other):
+        for table, other_stats in other.tables.items():
+            stats = self._table(table)
+            for name, value in other_stats.items():
+                stats[name] += value
+        self.failures.extend(other.failures)
+
+    @property
+    def inserted_rows(self):
+        return sum(stats["rows"] for stats in self.tables.values())
+
+    @property
+    def failed_rows(self):
+        return len(self.failures)
+
+    def failed_tables(self):
+        return sorted({failure["table"] for failure in self.failures})
+
+    def failed_rows_per_table(self):
+        counts = {}
+        for failure in self.failures:
+            counts[failure["table"]] = counts.get(failure["table"], 0) + 1
+        return counts
+
+    def failed_constraints(self):
+        # {table: {constraint or first line of the error: rows}}
+        constraints = {}
+        for failure in self.failures:
+            reason = failure["constraint"] or (failure["error"].splitlines() or ["unknown"])[0]
+            by_reason = constraints.setdefault(failure["table"], {})
+            by_reason[reason] = by_reason.get(reason, 0) + 1
+        return constraints
+
+    def rows_per_second(self, table):
+        stats = self.tables[table]
+        return stats["rows"] / stats["seconds"] if stats["seconds"] else 0.0
+
+    def summary(self):
+        return [
+            f"{table}: {stats['rows']} rows, {self.rows_per_second(table):,.0f} rows/s"
+            + (f", {stats['failed']} failed" if stats["failed"] else "")
+            for table, stats in self.tables.items()
+        ]
+
+
+def parse_literal(text):
+    text = text.strip()
+    upper = text.upper()
+    if upper == "NULL":
+        return None
+    if upper == "DEFAULT":
+        return _DEFAULT
+    if upper in ("TRUE", "FALSE"):
+        return upper == "TRUE"
+    typed = _TYPED_LITERAL_PATTERN.match(text)
+    if typed:
+        text = typed.group(2)
+    # drop trailing casts such as '2024-01-01'::date
+    text = re.sub(r"(::\s*[\w ]+(\(\d+(,\s*\d+)?\))?)+$", "", text).strip()
+    if len(text) >= 2 and text[0] == "'" and text[-1] == "'":
+        return text[1:-1].replace("''", "'")
+    if len(text) >= 3 and text[0] in "eE" and text[1] == "'" and text[-1] == "'":
+        return text[2:-1].replace("''", "'").encode("utf-8").decode("unicode_escape")
+    if _NUMBER_PATTERN.match(text):
+        return decimal.Decimal(text) if any(char in text for char in ".eE") else int(text)
+    raise UnsupportedStatement(f"Unsupported value expression: {text}")
+
+
+def parse_insert_statement(statement):
+    match = _INSERT_PATTERN.match(statement.strip())
+    if not match:
+        raise UnsupportedStatement("Not a plain INSERT ... VALUES statement.")
+    table = normalize_identifier(match.group(1))
+    columns = [normalize_identifier(column) for column in match.group(2).split(",")] if match.group(2) else None
+
+    rows = []
+    for group in split_top_level(match.group(3)):
+        if not (group.startswith("(") and group.endswith(")")):
+            # ON CONFLICT, RETURNING, INSERT ... SELECT, etc.
+            raise UnsupportedStatement(f"Unsupported INSERT clause: {group[:50]}")
+        rows.append([parse_literal(value) for value in split_top_level(group[1:-1])])
+    return table, columns, rows
+
+
+def parse_insert_script(script, column_lookup):
+    # consecutive INSERTs into the same table with the same columns are merged into one batch,
+    # anything that cannot be parsed is kept as a raw statement at its original position
+    operations = []
+    for statement in split_sql_statements(script):
+        try:
+            table, columns, rows = parse_insert_statement(statement)
+            columns = columns or column_lookup(table)
+        except UnsupportedStatement:
+            match = re.match(r"\s*(?:INSERT\s+INTO|UPDATE)\s+(\"[^\"]+\"|[\w.]+)", statement, re.I)
+            operations.append(RawStatement(statement, normalize_identifier(match.group(1)) if match else None))
+            continue
+
+        if any(len(row) != len(columns) for row in rows):
+            # the whole statement goes to the raw path, none of its rows into a batch
+            operations.append(RawStatement(statement, table))
+            continue
+        for row in rows:
+            # DEFAULT values are left to the database by omitting the column
+            row_columns = tuple(column for column, value in zip(columns, row) if value is not _DEFAULT)
+            values = [value for value in row if value is not _DEFAULT]
+            last = operations[-1] if operations else None
+            if not (isinstance(last, InsertBatch) and last.table == table and last.columns == row_columns):
+                last = InsertBatch(table, row_columns)
+                operations.append(last)
+            last.rows.append(values)
+    return operations
+
+
+def coerce_value(value, column_type):
+    if value is None or column_type is None:
+        return value
+    if isinstance(column_type, Boolean):
+        if isinstance(value, bool):
+            return value
+        lowered = str(value).strip().lower()
+        if lowered in _TRUE_VALUES:
+            return True
+        if lowered in _FALSE_VALUES:
+            return False
+        raise ValueError(f"'{value}' is not a boolean")
+    if isinstance(column_type, Integer):
+        number = decimal.Decimal(str(value).strip())
+        if number != number.to_integral_value():
+            raise ValueError(f"'{value}' is not an integer")
+        return int(number)
+    if isinstance(column_type, Float):
+        return float(value)
+    if isinstance(column_type, Numeric):
+        return decimal.Decimal(str(value).strip())
+    if isinstance(column_type, DateTime):
+        if isinstance(value, datetime.datetime):
+            return value
+        try:
+            return datetime.datetime.fromisoformat(str(value).strip())
+        except ValueError:
+            # CURRENT_TIMESTAMP, 'now', other formats postgres understands
+            return value
+    if isinstance(column_type, Date):
+        if isinstance(value, datetime.date):
+            return value
+        try:
+            return datetime.date.fromisoformat(str(value).strip())
+        except ValueError:
+            return value
+    if isinstance(column_type, Time):
+        return value
+    return value if isinstance(value, str) else str(value)
+
+
+def _copy_field(value):
+    # unquoted empty field is NULL in CSV COPY, everything else is quoted
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        value = "true" if value else "false"
+    elif isinstance(value, (datetime.date, datetime.datetime)):
+        value = value.isoformat()
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+def _copy_rows(cursor, table, columns, rows):
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write(",".join(_copy_field(value) for value in row))
+        buffer.write("\n")
+    buffer.seek(0)
+    column_sql = ", ".join(quote_identifier(column) for column in columns)
+    cursor.copy_expert(f"COPY {quote_identifier(table)} ({column_sql}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def _insert_values(cursor, table, columns, rows, page_size):
+    column_sql = ", ".join(quote_identifier(column) for column in columns)
+    execute_values(cursor, f"INSERT INTO {quote_identifier(table)} ({column_sql}) VALUES %s", rows, page_size=page_size)
+
+
+def _insert_row(cursor, table, columns, row):
+    column_sql = ", ".join(quote_identifier(column) for column in columns)
+    placeholders = ", ".join(["%s"] * len(columns))
+    cursor.execute(f"INSERT INTO {quote_identifier(table)} ({column_sql}) VALUES ({placeholders})", row)
+
+
+class _ColumnTypes:
+    def __init__(self, engine, catalog=None):
+        self.engine = engine
+        self.inspector = None
+        self._columns = dict(catalog.columns) if catalog is not None else {}
+
+    def columns(self, table):
+        if table not in self._columns:
+            if self.inspector is None:
+                self.inspector = inspect(self.engine)
+            try:
+                self._columns[table] = {
+                    column["name"]: column["type"] for column in self.inspector.get_columns(table)
+                }
+            except NoSuchTableError:
+                # left to the raw statement path, postgres reports the missing table
+                self._columns[table] = {}
+        return self._columns[table]
+
+    def column_names(self, table):
+        return list(self.columns(table))
+
+
+def _coerce_batch(batch, column_types, report):
+    types = column_types.columns(batch.table)
+    coerced = []
+    for row in batch.rows:
+        try:
+            coerced.append([coerce_value(value, types.get(column)) for column, value in zip(batch.columns, row)])
+        except (ValueError, ArithmeticError) as e:
+            report.add_failure(batch.table, dict(zip(batch.columns, row)), e)
+    return coerced
+
+
+def _constraint_name(error):
+    # postgres names the violated unique, foreign key, check or exclusion constraint; NOT NULL only has the column
+    diag = getattr(error, "diag", None)
+    if diag is None:
+        return None
+    if diag.constraint_name:
+        return diag.constraint_name
+    return f"{diag.column_name} NOT NULL" if diag.column_name and error.pgcode == "23502" else None
+
+
+def _load_batch(cursor, table, columns, rows, method, batch_size, report):
+    start = time.perf_counter()
+    cursor.execute("SAVEPOINT ingestion_batch")
+    try:
+        if method == "copy":
+            _copy_rows(cursor, table, columns, rows)
+        else:
+            _insert_values(cursor, table, columns, rows, batch_size)
+        cursor.execute("RELEASE SAVEPOINT ingestion_batch")
+        report.add_rows(table, len(rows), time.perf_counter() - start)
+        return
+    except psycopg2.Error:
+        cursor.execute("ROLLBACK TO SAVEPOINT ingestion_batch")
+
+    # the batch failed: load it row by row so only the bad rows are lost
+    loaded = 0
+    for row in rows:
+        cursor.execute("SAVEPOINT ingestion_row")
+        try:
+            _insert_row(cursor, table, columns, row)
+            cursor.execute("RELEASE SAVEPOINT ingestion_row")
+            loaded += 1
+        except psycopg2.Error as e:
+            cursor.execute("ROLLBACK TO SAVEPOINT ingestion_row")
+            report.add_failure(table, dict(zip(columns, row)), e.pgerror or e, _constraint_name(e))
+    report.add_rows(table, loaded, time.perf_counter() - start)
+
+
+def _execute_raw(cursor, operation, report):
+    table = operation.table or "unknown"
+    start = time.perf_counter()
+    cursor.execute("SAVEPOINT ingestion_raw")
+    try:
+        cursor.execute(operation.statement)
+        cursor.execute("RELEASE SAVEPOINT ingestion_raw")
+        report.add_rows(table, max(cursor.rowcount, 0), time.perf_counter() - start)
+    except psycopg2.Error as e:
+        cursor.execute("ROLLBACK TO SAVEPOINT ingestion_raw")
+        report.add_failure(table, operation.statement, e.pgerror or e, _constraint_name(e))
+
+
+def ingest_sql_script(engine, script, method=INGESTION_METHOD, batch_size=INGESTION_BATCH_SIZE, catalog=None):
+    report = IngestionReport()
+    column_types = _ColumnTypes(engine, catalog)
+    operations = parse_insert_script(script, column_types.column_names)
+
+    with engine.connect() as conn:
+        raw_connection = conn.connection
+        cursor = raw_connection.cursor()
+        try:
+            for operation in operations:
+                if isinstance(operation, RawStatement):
+                    _execute_raw(cursor, operation, report)
+                    continue
+                rows = _coerce_batch(operation, column_types, report)
+                for offset in range(0, len(rows), batch_size):
+                    _load_batch(
+                        cursor, operation.table, operation.columns, rows[offset:offset + batch_size],
+                        method, batch_size, report,
+                    )
+            raw_connection.commit()
+        except Exception:
+            raw_connection.rollback()
+            raise
+        finally:
+            cursor.close()
+            # every insert of the app goes through here; a raw statement on an unknown table invalidates all reads
+            tables = {operation.table for operation in operations}
+            read_cache.bump(engine, None if None in tables else tables)
+    return report
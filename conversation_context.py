@@ -0,0 +1,98 @@
+import os
+
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+CONTEXT_RECENT_TURNS = int(os.getenv("CONTEXT_RECENT_TURNS", "6"))
+CONTEXT_SAMPLE_ROWS = 3
+SUMMARY_SHARE = 0.3
+
+
+def estimate_tokens(text):
+    # ~4 characters per token is close enough for budgeting
+    return (len(text) + 3) // 4
+
+
+def _shorten(text, limit):
+    text = " ".join(str(text).split())
+    return text if len(text) <= limit else text[:limit - 3] + "..."
+
+
+def describe_message(message):
+    # compact form of a chat message: SQL and a short result summary instead of the data itself
+    if message["role"] == "user":
+        return f"User: {_shorten(message.get('text', ''), 500)}"
+
+    parts = [f"Assistant ({message['type']}): {_shorten(message.get('text') or '', 300)}"]
+    if message.get("sql"):
+        parts.append(f"SQL: {_shorten(message['sql'], 600)}")
+    content = message.get("content")
+    if content is not None and hasattr(content, "shape"):
+        parts.append(f"Result: {content.shape[0]} rows x {content.shape[1]} columns ({', '.join(map(str, content.columns))})")
+        if len(content):
+            sample = content.head(CONTEXT_SAMPLE_ROWS).to_csv(index=False).strip()
+            parts.append(f"Sample rows:\n{_shorten(sample, 400)}")
+    elif "rows" in message:
+        # result spilled to the message store, only its summary is kept in the message
+        parts.append(f"Result: {message['rows']} rows x {len(message['columns'])} columns ({', '.join(message['columns'])})")
+        if message.get("sample"):
+            parts.append(f"Sample rows:\n{_shorten(message['sample'], 400)}")
+    return "\n".join(parts)
+
+
+def summarize_older(message):
+    if message["role"] == "user":
+        return f"- asked: {_shorten(message.get('text', ''), 120)}"
+    if message.get("sql"):
+        return f"  answered with SQL: {_shorten(message['sql'], 160)}"
+    return f"  answered: {_shorten(message.get('text') or '', 120)}"
+
+
+class ContextBuilder:
+    def __init__(self, token_budget=CONTEXT_TOKEN_BUDGET, recent_turns=CONTEXT_RECENT_TURNS):
+        self.token_budget = token_budget
+        self.recent_turns = recent_turns
+        self.summary_lines = []
+        self.summarized_count = 0
+        self.last_tokens = 0
+
+    def _roll_into_summary(self, messages, upto):
+        # older messages are summarized once and the summary is reused on later turns
+        for message in messages[self.summarized_count:upto]:
+            self.summary_lines.append(summarize_older(message))
+        self.summarized_count = max(self.summarized_count, upto)
+
+    def _summary_text(self, budget):
+        lines = []
+        used = 0
+        for line in reversed(self.summary_lines):
+            cost = estimate_tokens(line) + 1
+            if used + cost > budget:
+                break
+            lines.append(line)
+            used += cost
+        if not lines:
+            return ""
+        return "Earlier in the conversation:\n" + "\n".join(reversed(lines))
+
+    def build(self, messages):
+        if len(messages) < self.summarized_count:
+            # the conversation was cleared
+            self.summary_lines = []
+            self.summarized_count = 0
+        window_start = max(0, len(messages) - self.recent_turns)
+        self._roll_into_summary(messages, window_start)
+
+        recent = [describe_message(message) for message in messages[max(window_start, self.summarized_count):]]
+        summary = self._summary_text(int(self.token_budget * SUMMARY_SHARE))
+
+        # enforce the budget by moving the oldest recent turns into the summary
+        while recent and estimate_tokens(summary + "\n\n".join(recent)) > self.token_budget:
+            self._roll_into_summary(messages, self.summarized_count + 1)
+            recent.pop(0)
+            summary = self._summary_text(int(self.token_budget * SUMMARY_SHARE))
+
+        context = "\n\n".join(part for part in [summary] + recent if part)
+        self.last_tokens = estimate_tokens(context)
+        print(f"Conversation context: {len(messages)} messages -> ~{self.last_tokens} tokens "
+              f"({len(recent)} recent, {len(self.summary_lines)} summarized)")
+        return context
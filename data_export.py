@@ -0,0 +1,106 @@
+import gzip
+import os
+import shutil
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from ddl_parser import quote_identifier
+
+
+EXPORT_WORKERS = int(os.getenv("EXPORT_WORKERS", "4"))
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "50000"))
+EXPORT_SPOOL_BYTES = 8 * 1024 * 1024
+EXPORT_DIR = os.path.join(tempfile.gettempdir(), "talk_with_database_exports")
+
+# format: (file name, mime type)
+EXPORT_FORMATS = {
+    "CSV": ("all_tables.csv", "text/csv"),
+    "CSV (gzip)": ("all_tables.csv.gz", "application/gzip"),
+    "ZIP": ("all_tables.zip", "application/zip"),
+    "Parquet (ZIP)": ("all_tables_parquet.zip", "application/zip"),
+}
+
+
+def copy_table_to_csv(engine, table_name, fileobj):
+    # COPY TO STDOUT streams the table straight into the file, nothing is held in memory
+    with engine.connect() as conn:
+        cursor = conn.connection.cursor()
+        try:
+            cursor.copy_expert(
+                f"COPY (SELECT * FROM {quote_identifier(table_name)}) TO STDOUT WITH (FORMAT csv, HEADER)", fileobj
+            )
+        finally:
+            cursor.close()
+    return fileobj
+
+
+def copy_table_to_parquet(engine, table_name, fileobj, chunk_rows=EXPORT_CHUNK_ROWS):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    writer = None
+    schema = None
+    with engine.connect().execution_options(stream_results=True, max_row_buffer=chunk_rows) as conn:
+        chunks = pd.read_sql(f"SELECT * FROM {quote_identifier(table_name)}", conn, chunksize=chunk_rows)
+        for chunk in chunks:
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if writer is None:
+                # columns that are all NULL in the first chunk are written as strings
+                schema = pa.schema([
+                    field.with_type(pa.string()) if pa.types.is_null(field.type) else field for field in table.schema
+                ])
+                writer = pq.ParquetWriter(fileobj, schema)
+            writer.write_table(table.cast(schema))
+    if writer is None:
+        # empty table: still write the columns
+        with engine.connect() as conn:
+            empty = pd.read_sql(f"SELECT * FROM {quote_identifier(table_name)} LIMIT 0", conn)
+        pq.write_table(pa.Table.from_pandas(empty, preserve_index=False), fileobj)
+    else:
+        writer.close()
+    return fileobj
+
+
+def _export_table(engine, table_name, export_format):
+    spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES, mode="w+b")
+    if export_format == "Parquet (ZIP)":
+        copy_table_to_parquet(engine, table_name, spool)
+    else:
+        copy_table_to_csv(engine, table_name, spool)
+    spool.seek(0)
+    return spool
+
+
+def export_tables(engine, tables, export_format, workers=EXPORT_WORKERS):
+    # tables are exported in parallel (one connection each) into spooled temp files,
+    # then copied chunk by chunk into a single file on disk
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    file_name, _ = EXPORT_FORMATS[export_format]
+    output = tempfile.NamedTemporaryFile(dir=EXPORT_DIR, suffix="_" + file_name, delete=False)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [(table, executor.submit(_export_table, engine, table, export_format)) for table in tables]
+        try:
+            if export_format in ("ZIP", "Parquet (ZIP)"):
+                extension = "parquet" if export_format == "Parquet (ZIP)" else "csv"
+                compression = zipfile.ZIP_STORED if extension == "parquet" else zipfile.ZIP_DEFLATED
+                with zipfile.ZipFile(output, "w", compression) as zip_file:
+                    for table, future in futures:
+                        with future.result() as spool, zip_file.open(f"{table}.{extension}", "w") as entry:
+                            shutil.copyfileobj(spool, entry)
+            else:
+                target = gzip.GzipFile(fileobj=output, mode="wb") if export_format == "CSV (gzip)" else output
+                for table, future in futures:
+                    target.write(f"=== TABLE: {table} ===\n".encode("utf-8"))
+                    with future.result() as spool:
+                        shutil.copyfileobj(spool, target)
+                    target.write(b"\n\n")
+                if target is not output:
+                    target.close()
+        except Exception:
+            output.close()
+            os.remove(output.name)
+            raise
+    output.close()
+    return output.name
@@ -0,0 +1,205 @@
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import text
+from data_export import EXPORT_SPOOL_BYTES
+from ddl_parser import quote_identifier
+from read_cache import read_cache
+from session_database import drop_schema
+
+
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", os.path.join(".cache", "snapshots"))
+SNAPSHOT_WORKERS = int(os.getenv("SNAPSHOT_WORKERS", "4"))
+MANIFEST_NAME = "manifest.json"
+
+
+def _copy_columns(conn, table_name):
+    # generated columns are computed again on restore, COPY FROM cannot write them
+    return conn.execute(text(
+        "SELECT column_name FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND table_name = :table AND is_generated = 'NEVER' "
+        "ORDER BY ordinal_position"
+    ), {"table": table_name}).scalars().all()
+
+
+def _column_sql(columns):
+    return ", ".join(quote_identifier(column) for column in columns)
+
+
+def _dump_table(engine, table_name):
+    # binary COPY TO STDOUT into a spooled temp file; returns (spool, columns, rows)
+    spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES, mode="w+b")
+    with engine.connect() as conn:
+        columns = _copy_columns(conn, table_name)
+        cursor = conn.connection.cursor()
+        try:
+            cursor.copy_expert(
+                f"COPY {quote_identifier(table_name)} ({_column_sql(columns)}) TO STDOUT WITH (FORMAT binary)", spool
+            )
+            rows = cursor.rowcount
+        finally:
+            cursor.close()
+    spool.seek(0)
+    return spool, columns, rows
+
+
+def save_snapshot(engine, ddl_hash, tables, parameters=None, label="", directory=SNAPSHOT_DIR, workers=SNAPSHOT_WORKERS):
+    # every table is dumped in parallel (one connection each) and written into one compressed archive
+    # together with a manifest: the DDL hash it can be restored into, the generation parameters and the row counts
+    start = time.perf_counter()
+    os.makedirs(directory, exist_ok=True)
+    created_at = datetime.datetime.now()
+    path = os.path.join(directory, f"{ddl_hash[:12]}_{created_at:%Y%m%d_%H%M%S_%f}.zip")
+    manifest = {
+        "ddl_hash": ddl_hash,
+        "label": label,
+        "created_at": created_at.isoformat(timespec="seconds"),
+        "parameters": parameters or {},
+        "tables": {},
+    }
+
+    partial = path + ".partial"
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [(table, executor.submit(_dump_table, engine, table)) for table in tables]
+        try:
+            with zipfile.ZipFile(partial, "w", zipfile.ZIP_DEFLATED) as archive:
+                for table, future in futures:
+                    spool, columns, rows = future.result()
+                    with spool, archive.open(f"{table}.copy", "w") as entry:
+                        shutil.copyfileobj(spool, entry)
+                    manifest["tables"][table] = {"columns": columns, "rows": rows}
+                # written last: an archive without a manifest is never listed
+                archive.writestr(MANIFEST_NAME, json.dumps(manifest, indent=2))
+        except Exception:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+    os.replace(partial, path)
+    print(f"Snapshot {path}: {sum(table['rows'] for table in manifest['tables'].values()):,} rows, "
+          f"{os.path.getsize(path):,} bytes ({time.perf_counter() - start:.2f}s)")
+    return path
+
+
+def read_manifest(path):
+    with zipfile.ZipFile(path) as archive:
+        manifest = json.loads(archive.read(MANIFEST_NAME))
+    manifest["path"] = path
+    manifest["bytes"] = os.path.getsize(path)
+    manifest["rows"] = sum(table["rows"] for table in manifest["tables"].values())
+    return manifest
+
+
+def list_snapshots(ddl_hash=None, directory=SNAPSHOT_DIR):
+    # newest first; only the snapshots of ddl_hash when it is given
+    if not os.path.isdir(directory):
+        return []
+    snapshots = []
+    for name in os.listdir(directory):
+        if not name.endswith(".zip"):
+            continue
+        try:
+            manifest = read_manifest(os.path.join(directory, name))
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile) as e:
+            print(f"Skipping unreadable snapshot {name}: {e}")
+            continue
+        if ddl_hash is None or manifest["ddl_hash"] == ddl_hash:
+            snapshots.append(manifest)
+    return sorted(snapshots, key=lambda manifest: manifest["created_at"], reverse=True)
+
+
+def delete_snapshot(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _load_table(engine, path, table_name, columns, staging):
+    # every worker opens the archive itself, a ZipFile is not shared between threads
+    with zipfile.ZipFile(path) as archive, archive.open(f"{table_name}.copy") as entry:
+        with engine.connect() as conn:
+            raw_connection = conn.connection
+            cursor = raw_connection.cursor()
+            try:
+                cursor.copy_expert(
+                    f"COPY {staging}.{quote_identifier(table_name)} ({_column_sql(columns)}) FROM STDIN WITH (FORMAT binary)",
+                    entry,
+                )
+                raw_connection.commit()
+                return cursor.rowcount
+            except Exception:
+                raw_connection.rollback()
+                raise
+            finally:
+                cursor.close()
+
+
+def _swap_in(conn, staging, tables):
+    # one transaction: foreign keys dropped, tables emptied and refilled from staging, foreign keys added back
+    # (and validated), sequences moved past the restored keys; any failure leaves the tables as they were
+    foreign_keys = conn.execute(text(
+        "SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE contype = 'f' AND connamespace = current_schema()::regnamespace"
+    )).fetchall()
+    for table, name, _ in foreign_keys:
+        conn.exec_driver_sql(f"ALTER TABLE {table} DROP CONSTRAINT {quote_identifier(name)}")
+    conn.exec_driver_sql(f"TRUNCATE {', '.join(quote_identifier(table) for table in tables)} RESTART IDENTITY")
+    for table, spec in tables.items():
+        columns = _column_sql(spec["columns"])
+        # identity columns declared GENERATED ALWAYS only take the restored keys with OVERRIDING SYSTEM VALUE
+        conn.exec_driver_sql(
+            f"INSERT INTO {quote_identifier(table)} ({columns}) OVERRIDING SYSTEM VALUE "
+            f"SELECT {columns} FROM {staging}.{quote_identifier(table)}"
+        )
+    for table, name, definition in foreign_keys:
+        conn.exec_driver_sql(f"ALTER TABLE {table} ADD CONSTRAINT {quote_identifier(name)} {definition.replace('%', '%%')}")
+    sequences = conn.execute(text(
+        "SELECT table_name, column_name, pg_get_serial_sequence(quote_ident(table_name), column_name) "
+        "FROM information_schema.columns WHERE table_schema = current_schema() "
+        "AND pg_get_serial_sequence(quote_ident(table_name), column_name) IS NOT NULL"
+    )).fetchall()
+    for table, column, sequence in sequences:
+        if table in tables:
+            conn.execute(text(
+                f"SELECT setval(:sequence, COALESCE(max({quote_identifier(column)}), 0) + 1, false) "
+                f"FROM {quote_identifier(table)}"
+            ), {"sequence": sequence})
+
+
+def restore_snapshot(engine, path, ddl_hash=None, workers=SNAPSHOT_WORKERS):
+    # replaces the contents of the snapshot's tables; the tables have to exist already (create_database).
+    # the archive is loaded in parallel into staging tables of a scratch schema first, so a failed load
+    # never touches the current data; then everything is swapped in at once. returns {table: rows}
+    manifest = read_manifest(path)
+    if ddl_hash is not None and manifest["ddl_hash"] != ddl_hash:
+        raise ValueError("The snapshot was taken from another DDL schema.")
+    tables = manifest["tables"]
+    if not tables:
+        return {}
+
+    staging = f"_restore_{uuid.uuid4().hex[:12]}"
+    try:
+        with engine.begin() as conn:
+            conn.exec_driver_sql(f"CREATE SCHEMA {staging}")
+            for table, spec in tables.items():
+                # the same column types as the live table, without constraints or defaults
+                conn.exec_driver_sql(
+                    f"CREATE TABLE {staging}.{quote_identifier(table)} AS "
+                    f"SELECT {_column_sql(spec['columns'])} FROM {quote_identifier(table)} WITH NO DATA"
+                )
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                table: executor.submit(_load_table, engine, path, table, spec["columns"], staging)
+                for table, spec in tables.items()
+            }
+            rows = {table: future.result() for table, future in futures.items()}
+        with engine.begin() as conn:
+            _swap_in(conn, staging, tables)
+    finally:
+        drop_schema(engine, staging)
+    read_cache.bump(engine, set(tables))
+    return rows
@@ -0,0 +1,405 @@
+import re
+from collections import OrderedDict
+
+
+COLUMN_KEYWORDS = ("NOT", "NULL", "PRIMARY", "UNIQUE", "REFERENCES", "DEFAULT", "CHECK", "CONSTRAINT", "GENERATED", "COLLATE")
+TABLE_CONSTRAINT_KEYWORDS = ("PRIMARY", "FOREIGN", "UNIQUE", "CHECK", "CONSTRAINT", "EXCLUDE")
+
+
+class ColumnDef:
+    def __init__(self, name, data_type):
+        self.name = name
+        self.data_type = data_type
+        self.not_null = False
+        self.unique = False
+        self.primary_key = False
+        self.default = None
+        self.check = None
+        self.references = None
+
+    @property
+    def base_type(self):
+        return re.split(r"[\s(\[]", self.data_type.lower(), maxsplit=1)[0]
+
+    @property
+    def type_args(self):
+        match = re.search(r"\(([^)]*)\)", self.data_type)
+        if not match:
+            return []
+        return [int(arg) for arg in re.findall(r"\d+", match.group(1))]
+
+    @property
+    def is_serial(self):
+        return self.base_type in ("serial", "bigserial", "smallserial")
+
+    def __repr__(self):
+        return f"ColumnDef({self.name!r}, {self.data_type!r})"
+
+
+class ForeignKey:
+    def __init__(self, columns, ref_table, ref_columns, name=None):
+        self.columns = columns
+        self.ref_table = ref_table
+        self.ref_columns = ref_columns
+        self.name = name
+
+    def __repr__(self):
+        return f"ForeignKey({self.columns} -> {self.ref_table}{self.ref_columns})"
+
+
+class TableDef:
+    def __init__(self, name):
+        self.name = name
+        self.columns = OrderedDict()
+        self.primary_key = []
+        self.foreign_keys = []
+        self.unique_constraints = []
+        self.checks = []
+        self.statement = None
+
+    def __repr__(self):
+        return f"TableDef({self.name!r}, {list(self.columns)})"
+
+
+class SchemaDef:
+    def __init__(self):
+        self.enums = OrderedDict()
+        self.tables = OrderedDict()
+        self.statements = []
+
+    def table_ddl(self, table_name):
+        # CREATE TABLE statement plus the ALTER TABLE statements touching the table and the enums it uses
+        table = self.tables[table_name]
+        used_enums = [column.base_type for column in table.columns.values() if column.base_type in self.enums]
+        parts = [self.enum_ddl(enum) for enum in used_enums]
+        parts.append(table.statement)
+        parts.extend(
+            stmt for stmt in self.statements
+            if stmt.upper().startswith("ALTER TABLE") and alter_target(stmt) == table_name
+        )
+        return ";\n".join(parts) + ";"
+
+    def enum_ddl(self, enum_name):
+        values = ", ".join("'" + value.replace("'", "''") + "'" for value in self.enums[enum_name])
+        return f"CREATE TYPE {enum_name} AS ENUM ({values})"
+
+
+def normalize_identifier(identifier):
+    identifier = identifier.strip()
+    if identifier.startswith('"') and identifier.endswith('"'):
+        return identifier[1:-1]
+    # drop schema qualification, postgres folds unquoted names to lower case
+    return identifier.split(".")[-1].lower()
+
+
+def quote_identifier(name):
+    if re.match(r"^[a-z_][a-z0-9_]*$", name):
+        return name
+    return '"' + name.replace('"', '""') + '"'
+
+
+def strip_comments(script):
+    script = re.sub(r"/\*.*?\*/", "", script, flags=re.S)
+    lines = []
+    for line in script.splitlines():
+        lines.append(_strip_line_comment(line))
+    return "\n".join(lines)
+
+
+def _strip_line_comment(line):
+    in_quote = False
+    for i, char in enumerate(line):
+        if char == "'":
+            in_quote = not in_quote
+        elif char == "-" and not in_quote and line[i:i + 2] == "--":
+            return line[:i]
+    return line
+
+
+def split_top_level(text, separator=","):
+    parts = []
+    depth = 0
+    in_quote = False
+    current = []
+    for char in text:
+        if char == "'":
+            in_quote = not in_quote
+        elif not in_quote:
+            if char == "(":
+                depth += 1
+            elif char == ")":
+                depth -= 1
+            elif char == separator and depth == 0:
+                parts.append("".join(current).strip())
+                current = []
+                continue
+        current.append(char)
+    tail = "".join(current).strip()
+    if tail:
+        parts.append(tail)
+    return [part for part in parts if part]
+
+
+def split_sql_statements(script):
+    return split_top_level(strip_comments(script), separator=";")
+
+
+def _identifier_list(text):
+    return [normalize_identifier(name) for name in text.split(",") if name.strip()]
+
+
+def alter_target(statement):
+    match = re.match(r"ALTER\s+TABLE\s+(?:ONLY\s+)?(?:IF\s+EXISTS\s+)?(\"[^\"]+\"|[\w.]+)", statement, re.I)
+    return normalize_identifier(match.group(1)) if match else None
+
+
+def _find_top_level_keyword(text, keywords):
+    # index of the first keyword outside parentheses and quotes
+    depth = 0
+    in_quote = False
+    for match in re.finditer(r"'|\(|\)|\b[A-Za-z_]+\b", text):
+        token = match.group(0)
+        if token == "'":
+            in_quote = not in_quote
+        elif in_quote:
+            continue
+        elif token == "(":
+            depth += 1
+        elif token == ")":
+            depth -= 1
+        elif depth == 0 and token.upper() in keywords:
+            return match.start()
+    return len(text)
+
+
+def _take_parenthesized(text):
+    # returns (content of the leading (...) group, rest)
+    text = text.lstrip()
+    if not text.startswith("("):
+        return "", text
+    depth = 0
+    for i, char in enumerate(text):
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+            if depth == 0:
+                return text[1:i], text[i + 1:]
+    return text[1:], ""
+
+
+def _parse_default(text):
+    # DEFAULT value ends where the next column constraint keyword starts
+    end = _find_top_level_keyword(text, COLUMN_KEYWORDS)
+    return text[:end].strip(), text[end:]
+
+
+def _parse_references(text):
+    match = re.match(r"\s*REFERENCES\s+(\"[^\"]+\"|[\w.]+)\s*", text, re.I)
+    ref_table = normalize_identifier(match.group(1))
+    rest = text[match.end():]
+    ref_columns = []
+    if rest.lstrip().startswith("("):
+        columns, rest = _take_parenthesized(rest)
+        ref_columns = _identifier_list(columns)
+    # skip ON DELETE / ON UPDATE / MATCH / DEFERRABLE clauses
+    end = _find_top_level_keyword(rest, COLUMN_KEYWORDS + ("FOREIGN",))
+    return ref_table, ref_columns, rest[end:]
+
+
+def _parse_column(table, definition):
+    match = re.match(r"(\"[^\"]+\"|\w+)\s+(.*)$", definition, re.S)
+    name = normalize_identifier(match.group(1))
+    rest = match.group(2)
+    type_end = _find_top_level_keyword(rest, COLUMN_KEYWORDS)
+    column = ColumnDef(name, " ".join(rest[:type_end].split()))
+    rest = rest[type_end:]
+
+    while rest.strip():
+        rest = rest.strip()
+        upper = rest.upper()
+        if upper.startswith("CONSTRAINT"):
+            rest = re.sub(r"^CONSTRAINT\s+(\"[^\"]+\"|\w+)", "", rest, flags=re.I)
+        elif upper.startswith("NOT NULL"):
+            column.not_null = True
+            rest = rest[len("NOT NULL"):]
+        elif upper.startswith("NULL"):
+            rest = rest[len("NULL"):]
+        elif upper.startswith("PRIMARY KEY"):
+            column.primary_key = True
+            column.not_null = True
+            rest = rest[len("PRIMARY KEY"):]
+        elif upper.startswith("UNIQUE"):
+            column.unique = True
+            rest = rest[len("UNIQUE"):]
+        elif upper.startswith("DEFAULT"):
+            column.default, rest = _parse_default(rest[len("DEFAULT"):])
+        elif upper.startswith("CHECK"):
+            column.check, rest = _take_parenthesized(rest[len("CHECK"):])
+            table.checks.append(column.check)
+        elif upper.startswith("REFERENCES"):
+            ref_table, ref_columns, rest = _parse_references(rest)
+            column.references = (ref_table, ref_columns[0] if ref_columns else None)
+            table.foreign_keys.append(ForeignKey([name], ref_table, ref_columns))
+        else:
+            # GENERATED ..., COLLATE ... and anything unknown: skip one token
+            parts = rest.split(None, 1)
+            rest = parts[1] if len(parts) > 1 else ""
+
+    if column.primary_key:
+        table.primary_key = [name]
+    table.columns[name] = column
+
+
+def _parse_table_constraint(table, definition):
+    constraint_name = None
+    match = re.match(r"CONSTRAINT\s+(\"[^\"]+\"|\w+)\s+(.*)$", definition, re.I | re.S)
+    if match:
+        constraint_name = normalize_identifier(match.group(1))
+        definition = match.group(2)
+    upper = definition.upper()
+
+    if upper.startswith("PRIMARY KEY"):
+        columns, _ = _take_parenthesized(definition[len("PRIMARY KEY"):])
+        table.primary_key = _identifier_list(columns)
+        for name in table.primary_key:
+            if name in table.columns:
+                table.columns[name].not_null = True
+    elif upper.startswith("FOREIGN KEY"):
+        columns, rest = _take_parenthesized(definition[len("FOREIGN KEY"):])
+        ref_table, ref_columns, _ = _parse_references(rest)
+        add_foreign_key(table, ForeignKey(_identifier_list(columns), ref_table, ref_columns, constraint_name))
+    elif upper.startswith("UNIQUE"):
+        columns, _ = _take_parenthesized(definition[len("UNIQUE"):])
+        names = _identifier_list(columns)
+        table.unique_constraints.append(names)
+        if len(names) == 1 and names[0] in table.columns:
+            table.columns[names[0]].unique = True
+    elif upper.startswith("CHECK"):
+        check, _ = _take_parenthesized(definition[len("CHECK"):])
+        table.checks.append(check)
+
+
+def add_foreign_key(table, foreign_key):
+    table.foreign_keys.append(foreign_key)
+    if len(foreign_key.columns) == 1 and foreign_key.columns[0] in table.columns:
+        ref_column = foreign_key.ref_columns[0] if foreign_key.ref_columns else None
+        table.columns[foreign_key.columns[0]].references = (foreign_key.ref_table, ref_column)
+
+
+def _parse_create_table(schema, statement):
+    match = re.match(
+        r"CREATE\s+(?:UNLOGGED\s+|TEMP\s+|TEMPORARY\s+)?TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?(\"[^\"]+\"|[\w.]+)\s*",
+        statement, re.I,
+    )
+    table = TableDef(normalize_identifier(match.group(1)))
+    table.statement = statement
+    body, _ = _take_parenthesized(statement[match.end():])
+
+    definitions = split_top_level(body)
+    for definition in definitions:
+        if definition.split(None, 1)[0].upper() not in TABLE_CONSTRAINT_KEYWORDS:
+            _parse_column(table, definition)
+    for definition in definitions:
+        if definition.split(None, 1)[0].upper() in TABLE_CONSTRAINT_KEYWORDS:
+            _parse_table_constraint(table, definition)
+    schema.tables[table.name] = table
+
+
+def _parse_alter_table(schema, statement):
+    table = schema.tables.get(alter_target(statement))
+    if table is None:
+        return
+    for action in split_top_level(re.sub(r"^ALTER\s+TABLE\s+\S+", "", statement, flags=re.I)):
+        match = re.match(r"ADD\s+(?:COLUMN\s+)?(.*)$", action, re.I | re.S)
+        if not match:
+            continue
+        definition = match.group(1)
+        if definition.split(None, 1)[0].upper() in TABLE_CONSTRAINT_KEYWORDS:
+            _parse_table_constraint(table, definition)
+        else:
+            _parse_column(table, definition)
+
+
+def parse_ddl(ddl_script):
+    schema = SchemaDef()
+    for statement in split_sql_statements(ddl_script):
+        schema.statements.append(statement)
+        upper = " ".join(statement.split()).upper()
+        enum_match = re.match(
+            r"CREATE\s+TYPE\s+(\"[^\"]+\"|[\w.]+)\s+AS\s+ENUM\s*\((.*)\)\s*$", statement, re.I | re.S
+        )
+        if enum_match:
+            values = re.findall(r"'((?:[^']|'')*)'", enum_match.group(2))
+            schema.enums[normalize_identifier(enum_match.group(1))] = [value.replace("''", "'") for value in values]
+        elif re.match(r"CREATE\s+(UNLOGGED\s+|TEMP\s+|TEMPORARY\s+)?TABLE", upper):
+            _parse_create_table(schema, statement)
+        elif upper.startswith("ALTER TABLE"):
+            _parse_alter_table(schema, statement)
+    return schema
+
+
+def dependency_levels(schema):
+    # groups tables into levels where every table only references tables from earlier levels;
+    # FK cycles are broken on nullable columns which are returned as deferred (table, column) pairs
+    edges = OrderedDict()
+    for table in schema.tables.values():
+        edges[table.name] = {}
+        for foreign_key in table.foreign_keys:
+            if foreign_key.ref_table != table.name and foreign_key.ref_table in schema.tables:
+                edges[table.name].setdefault(foreign_key.ref_table, []).append(foreign_key)
+
+    # 1. find the edges that have to be deferred to make the graph acyclic
+    deferred = []
+    remaining = OrderedDict((name, dict(parents)) for name, parents in edges.items())
+    while remaining:
+        ready = [name for name, parents in remaining.items() if not parents]
+        if not ready:
+            ready = _break_cycle(schema, remaining, deferred)
+        _remove_ready(remaining, ready)
+
+    # 2. level the acyclic graph so independent tables share a level
+    deferred_tables = {name for name, _ in deferred}
+    levels = []
+    remaining = OrderedDict()
+    for name, parents in edges.items():
+        remaining[name] = {
+            parent: foreign_keys for parent, foreign_keys in parents.items()
+            if name not in deferred_tables
+            or any((name, column) not in deferred for foreign_key in foreign_keys for column in foreign_key.columns)
+        }
+    while remaining:
+        ready = [name for name, parents in remaining.items() if not parents] or list(remaining)
+        levels.append(ready)
+        _remove_ready(remaining, ready)
+    return levels, deferred
+
+
+def _remove_ready(remaining, ready):
+    for name in ready:
+        del remaining[name]
+    for parents in remaining.values():
+        for name in ready:
+            parents.pop(name, None)
+
+
+def _break_cycle(schema, remaining, deferred):
+    # drop the nullable FK edges of the table with the fewest blocking parents
+    candidates = sorted(remaining, key=lambda name: len(remaining[name]))
+    for name in candidates:
+        table = schema.tables[name]
+        parents = remaining[name]
+        if all(
+            not table.columns[column].not_null
+            for foreign_keys in parents.values()
+            for foreign_key in foreign_keys
+            for column in foreign_key.columns
+            if column in table.columns
+        ):
+            for foreign_keys in parents.values():
+                for foreign_key in foreign_keys:
+                    deferred.extend((name, column) for column in foreign_key.columns)
+            parents.clear()
+            return [name]
+    # cycle made only of NOT NULL references, the database has to resolve it
+    return list(remaining)
@@ -0,0 +1,227 @@
+import contextvars
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from bulk_ingestion import IngestionReport
+from databse_operations import add_data_to_database, clean_sql_query
+from streaming_ingestion import complete_statements
+from ddl_parser import parse_ddl, dependency_levels
+from read_cache import read_cache
+
+
+GENERATION_WORKERS = int(os.getenv("GENERATION_WORKERS", "4"))
+MAX_PARENT_KEYS = 200
+MAX_USED_KEYS = 500
+MAX_EMPTY_PAGES = 3
+INTEGER_TYPES = {"int", "integer", "int2", "int4", "int8", "smallint", "bigint", "serial", "bigserial", "smallserial"}
+MAX_TABLE_RETRIES = 3
+
+
+def fetch_parent_keys(engine, schema, table, deferred, max_keys=MAX_PARENT_KEYS):
+    parent_keys = {}
+    with engine.connect() as conn:
+        for foreign_key in table.foreign_keys:
+            if any((table.name, column) in deferred for column in foreign_key.columns):
+                continue
+            parent = schema.tables.get(foreign_key.ref_table)
+            if parent is None:
+                continue
+            ref_columns = foreign_key.ref_columns or parent.primary_key
+            if not ref_columns:
+                continue
+            query = f"SELECT DISTINCT {', '.join(ref_columns)} FROM {parent.name} ORDER BY 1 LIMIT :limit"
+            rows = conn.execute(text(query), {"limit": max_keys}).fetchall()
+            values = [row[0] if len(row) == 1 else tuple(row) for row in rows]
+            label = f"{', '.join(foreign_key.columns)} -> {parent.name}({', '.join(ref_columns)})"
+            parent_keys[label] = values
+    return parent_keys
+
+
+def fetch_used_keys(engine, table, max_keys=MAX_USED_KEYS):
+    # values already taken in the primary key and unique columns; a regenerated batch must not repeat them
+    key_columns = [table.primary_key] if table.primary_key else []
+    key_columns += [columns for columns in table.unique_constraints if columns not in key_columns]
+    key_columns += [[column.name] for column in table.columns.values() if column.unique and [column.name] not in key_columns]
+    used_keys = {}
+    with engine.connect() as conn:
+        for columns in key_columns:
+            column = table.columns.get(columns[0]) if len(columns) == 1 else None
+            if column is not None and column.base_type in INTEGER_TYPES:
+                # integer keys are sent as a range, however many rows there are
+                low, high = conn.execute(text(f"SELECT min({columns[0]}), max({columns[0]}) FROM {table.name}")).one()
+                if low is not None:
+                    used_keys[columns[0]] = [f"{low} to {high} (continue from {high + 1})"]
+                continue
+            # the highest values first, so the model can continue after them
+            query = f"SELECT DISTINCT {', '.join(columns)} FROM {table.name} ORDER BY 1 DESC LIMIT :limit"
+            rows = conn.execute(text(query), {"limit": max_keys}).fetchall()
+            if rows:
+                used_keys[", ".join(columns)] = [row[0] if len(row) == 1 else tuple(row) for row in rows]
+    return used_keys
+
+
+def regenerate_failed_tables(model, ddl_schema, session_state, report, prompt="", temperature=0.5, max_tokens=10000,
+                             on_progress=None):
+    # asks the model again only for the tables that had rows rejected, only for as many rows as were lost,
+    # with the keys already in use and the violated constraints as context; everything loaded so far is kept.
+    # parents are regenerated before their children. returns the report of this round, None if nothing could be retried
+    schema = parse_ddl(ddl_schema)
+    levels, _ = dependency_levels(schema)
+    engine = session_state.engine
+    progress = print if on_progress is None else on_progress
+    lost_rows = report.failed_rows_per_table()
+    rejected = report.failed_constraints()
+    tables = [table_name for level in levels for table_name in level if table_name in lost_rows]
+    if not tables:
+        return None
+
+    retry_report = IngestionReport()
+    for table_name in tables:
+        table = schema.tables[table_name]
+        progress(f"Regenerating {lost_rows[table_name]} rows of {table_name} "
+                 f"({', '.join(f'{reason}: {rows}' for reason, rows in rejected[table_name].items())})")
+        response = model.generate_table_data(
+            schema.table_ddl(table_name),
+            table_name,
+            # every table the first attempt loaded is a parent now, nothing has to be deferred
+            parent_keys=fetch_parent_keys(engine, schema, table, set()),
+            used_keys=fetch_used_keys(engine, table),
+            row_count=lost_rows[table_name],
+            rejected=rejected[table_name],
+            prompt=prompt,
+            temperature=temperature,
+            max_output_tokens=max_tokens,
+        )
+        table_report = add_data_to_database(clean_sql_query(response), session_state)
+        if table_report is not None:
+            retry_report.merge(table_report)
+    return retry_report
+
+
+def generate_to_targets(model, ddl_schema, session_state, targets, page_rows, prompt="", temperature=0.5,
+                        max_tokens=10000, on_progress=None):
+    # fills every table up to targets[table] rows, one page of at most page_rows rows per request, parents first.
+    # each page is told the parent keys and the keys already used, its truncated tail is dropped and it is
+    # inserted before the next one is requested. on_progress(table, rows, target, rows_per_second, eta_seconds)
+    schema = parse_ddl(ddl_schema)
+    levels, deferred = dependency_levels(schema)
+    engine = session_state.engine
+    progress = on_progress or (lambda table, rows, target, rate, eta: print(
+        f"{table}: {rows:,}/{target:,} rows ({rate:,.0f} rows/s, ~{eta:.0f}s left)"
+    ))
+    with engine.connect() as conn:
+        rows = {
+            table_name: conn.execute(text(f"SELECT count(*) FROM {table_name}")).scalar()
+            for table_name in targets if table_name in schema.tables
+        }
+    start = time.perf_counter()
+    inserted = 0
+    report = IngestionReport()
+
+    for table_name in [name for level in levels for name in level if name in rows]:
+        table = schema.tables[table_name]
+        empty_pages = 0
+        while rows[table_name] < targets[table_name] and empty_pages < MAX_EMPTY_PAGES:
+            response = model.generate_table_data(
+                schema.table_ddl(table_name),
+                table_name,
+                parent_keys=fetch_parent_keys(engine, schema, table, deferred),
+                null_columns=[column for name, column in deferred if name == table_name],
+                used_keys=fetch_used_keys(engine, table),
+                row_count=min(page_rows, targets[table_name] - rows[table_name]),
+                prompt=prompt,
+                temperature=temperature,
+                max_output_tokens=max_tokens,
+            )
+            statements, truncated = complete_statements(clean_sql_query(response or ""))
+            if truncated:
+                print(f"Dropped truncated statement of {table_name} ({len(truncated)} characters), lower the page size")
+            page_report = add_data_to_database(";\n".join(statements), session_state) if statements else None
+            page_rows_loaded = page_report.inserted_rows if page_report is not None else 0
+            if page_report is not None:
+                report.merge(page_report)
+            # a page that adds nothing (all duplicates, empty response) is retried a few times, then the table is left
+            empty_pages = empty_pages + 1 if not page_rows_loaded else 0
+            rows[table_name] += page_rows_loaded
+            inserted += page_rows_loaded
+
+            elapsed = time.perf_counter() - start
+            rate = inserted / elapsed if elapsed else 0.0
+            remaining = sum(max(targets[name] - count, 0) for name, count in rows.items())
+            progress(table_name, rows[table_name], targets[table_name], rate, remaining / rate if rate else float("inf"))
+        if rows[table_name] < targets[table_name]:
+            print(f"{table_name} stopped at {rows[table_name]:,} of {targets[table_name]:,} rows")
+
+    if deferred:
+        fill_deferred_columns(engine, schema, deferred)
+    return rows, report
+
+
+def fill_deferred_columns(engine, schema, deferred):
+    # columns left NULL to break FK cycles get a random existing parent key once every table is loaded
+    with engine.begin() as conn:
+        for table_name, column in deferred:
+            table = schema.tables[table_name]
+            reference = table.columns[column].references if column in table.columns else None
+            if reference is None or not table.primary_key:
+                continue
+            ref_table, ref_column = reference
+            ref_column = ref_column or schema.tables[ref_table].primary_key[0]
+            pk = table.primary_key[0]
+            conn.execute(text(
+                f"UPDATE {table_name} AS child SET {column} = "
+                f"(SELECT {ref_column} FROM {ref_table} WHERE child.{pk} = child.{pk} ORDER BY random() LIMIT 1)"
+            ))
+    read_cache.bump(engine, {table_name for table_name, _ in deferred})
+
+
+def generate_by_dependency_levels(model, ddl_schema, session_state, prompt="", temperature=0.5, max_tokens=10000,
+                                  max_workers=GENERATION_WORKERS, on_progress=None):
+    schema = parse_ddl(ddl_schema)
+    levels, deferred = dependency_levels(schema)
+    engine = session_state.engine
+    progress = print if on_progress is None else on_progress
+    start = time.perf_counter()
+
+    def generate(table_name):
+        table = schema.tables[table_name]
+        return model.generate_table_data(
+            schema.table_ddl(table_name),
+            table_name,
+            parent_keys=fetch_parent_keys(engine, schema, table, deferred),
+            null_columns=[column for name, column in deferred if name == table_name],
+            prompt=prompt,
+            temperature=temperature,
+            max_output_tokens=max_tokens,
+        )
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for level_number, level in enumerate(levels, 1):
+            # each call runs in a copy of the caller's context so its spans join the current request trace
+            futures = {
+                executor.submit(contextvars.copy_context().run, generate, table_name): table_name for table_name in level
+            }
+            # insert every table as soon as its response arrives, children only start after the whole level
+            for future in as_completed(futures):
+                table_name = futures[future]
+                response = future.result()
+                for attempt in range(MAX_TABLE_RETRIES):
+                    try:
+                        report = add_data_to_database(clean_sql_query(response), session_state)
+                        # regenerate only when nothing of the table could be loaded
+                        if report is None or report.inserted_rows or not report.failed_rows:
+                            break
+                        error = report.failures[0]["error"]
+                    except SQLAlchemyError as e:
+                        error = e
+                    if attempt == MAX_TABLE_RETRIES - 1:
+                        raise RuntimeError(f"Generating {table_name} failed after {MAX_TABLE_RETRIES} attempts: {error}")
+                    print(f"Inserting {table_name} failed (attempt {attempt + 1}): {error}. Regenerating table...")
+                    response = generate(table_name)
+            progress(f"Level {level_number}/{len(levels)} done: {', '.join(level)} ({time.perf_counter() - start:.1f}s)")
+
+    if deferred:
+        fill_deferred_columns(engine, schema, deferred)
+    return levels
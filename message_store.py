@@ -0,0 +1,102 @@
+import os
+import shutil
+import tempfile
+import time
+import uuid
+import weakref
+import pandas as pd
+from response_cache import MemoryLRU, _MISSING
+
+
+MESSAGE_STORE_DIR = os.getenv(
+    "MESSAGE_STORE_DIR", os.path.join(tempfile.gettempdir(), "talk_with_database_messages")
+)
+MESSAGE_CACHE_ENTRIES = int(os.getenv("MESSAGE_CACHE_ENTRIES", "8"))
+MESSAGE_EXPANDED_COUNT = int(os.getenv("MESSAGE_EXPANDED_COUNT", "4"))
+MESSAGE_STORE_TTL_HOURS = float(os.getenv("MESSAGE_STORE_TTL_HOURS", "24"))
+SAMPLE_ROWS = 3
+
+
+def remove_stale_sessions(directory=MESSAGE_STORE_DIR, ttl_hours=MESSAGE_STORE_TTL_HOURS):
+    # stores of sessions that ended without cleaning up (e.g. the server was killed)
+    if not os.path.isdir(directory):
+        return
+    cutoff = time.time() - ttl_hours * 3600
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if os.path.isdir(path) and os.path.getmtime(path) < cutoff:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+class MessageStore:
+    # chat history whose DataFrames and images live on disk; messages keep only text, SQL and a result summary
+    def __init__(self, directory=MESSAGE_STORE_DIR, cache_entries=MESSAGE_CACHE_ENTRIES):
+        remove_stale_sessions(directory)
+        self.directory = os.path.join(directory, uuid.uuid4().hex)
+        os.makedirs(self.directory, exist_ok=True)
+        self.messages = []
+        self.cache = MemoryLRU(max_entries=cache_entries)
+        self._next_id = 0
+        # the files go away together with the session
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.directory, True)
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def __getitem__(self, index):
+        return self.messages[index]
+
+    def _path(self, message):
+        extension = "parquet" if message["type"] == "DATA" else message["image_format"]
+        return os.path.join(self.directory, f"{message['id']}.{extension}")
+
+    def append(self, message):
+        message = dict(message)
+        message["id"] = self._next_id
+        self._next_id += 1
+        payload = message.pop("content", None)
+        if payload is None:
+            payload = message.pop("image", None)
+        self.messages.append(message)
+        if payload is not None:
+            self.set_payload(message, payload)
+        return message
+
+    def set_payload(self, message, payload):
+        # written once per result (or result page) and kept in the LRU while it is recent
+        path = self._path(message)
+        if isinstance(payload, pd.DataFrame):
+            payload.to_parquet(path, index=False)
+            message["rows"], message["columns"] = len(payload), [str(column) for column in payload.columns]
+            message["sample"] = payload.head(SAMPLE_ROWS).to_csv(index=False).strip() if len(payload) else ""
+        else:
+            with open(path, "wb") as f:
+                f.write(payload)
+        message["has_payload"] = True
+        self.cache.set(message["id"], payload)
+
+    def payload(self, message):
+        if not message.get("has_payload"):
+            return None
+        payload = self.cache.get(message["id"])
+        if payload is _MISSING:
+            path = self._path(message)
+            if message["type"] == "DATA":
+                payload = pd.read_parquet(path)
+            else:
+                with open(path, "rb") as f:
+                    payload = f.read()
+            self.cache.set(message["id"], payload)
+        return payload
+
+    def disk_bytes(self):
+        return sum(entry.stat().st_size for entry in os.scandir(self.directory) if entry.is_file())
+
+    def clear(self):
+        self.messages = []
+        self.cache.clear()
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
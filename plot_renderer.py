@@ -0,0 +1,154 @@
+import hashlib
+import io
+import multiprocessing
+import os
+import signal
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from response_cache import MemoryLRU, _MISSING
+
+try:
+    import resource
+except ImportError:
+    # resource limits are only available on Unix
+    resource = None
+
+
+PLOT_WORKERS = int(os.getenv("PLOT_WORKERS", "2"))
+PLOT_CPU_SECONDS = int(os.getenv("PLOT_CPU_SECONDS", "10"))
+PLOT_MEMORY_MB = int(os.getenv("PLOT_MEMORY_MB", "2048"))
+PLOT_TIMEOUT = float(os.getenv("PLOT_TIMEOUT", "30"))
+PLOT_FORMAT = os.getenv("PLOT_FORMAT", "png")
+PLOT_CACHE_ENTRIES = int(os.getenv("PLOT_CACHE_ENTRIES", "64"))
+PLOT_DPI = 100
+
+class PlotRenderError(RuntimeError):
+    pass
+
+
+def dataframe_to_arrow(df):
+    import pyarrow as pa
+
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowException, ValueError, TypeError) as e:
+        # e.g. a column mixing numbers and strings
+        raise PlotRenderError(f"The query result cannot be plotted: {e}")
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def _cpu_time_exceeded(signum, frame):
+    raise PlotRenderError("Plot rendering exceeded the CPU time limit.")
+
+
+def _init_worker(memory_mb):
+    # runs once in every worker process: headless backend, memory limit, SIGXCPU raises instead of killing
+    import matplotlib
+    matplotlib.use("Agg")
+    if resource is not None:
+        limit = memory_mb * 1024 * 1024
+        _, hard = resource.getrlimit(resource.RLIMIT_AS)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, hard if hard == resource.RLIM_INFINITY else min(limit, hard)))
+        signal.signal(signal.SIGXCPU, _cpu_time_exceeded)
+
+
+def _render(code, arrow_data, image_format, cpu_seconds):
+    import pandas as pd
+    import pyarrow as pa
+    import seaborn as sns
+    import matplotlib.pyplot as plt
+
+    if resource is not None:
+        # RLIMIT_CPU counts the whole life of the process, so the limit is moved forward for every plot
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        used = int(usage.ru_utime + usage.ru_stime) + 1
+        _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+        resource.setrlimit(resource.RLIMIT_CPU, (used + cpu_seconds, hard))
+
+    df = pa.ipc.open_stream(arrow_data).read_pandas()
+    plt.close("all")
+    try:
+        exec(code, {}, {"pd": pd, "sns": sns, "plt": plt, "df": df})
+        output = io.BytesIO()
+        plt.gcf().savefig(output, format=image_format, dpi=PLOT_DPI, bbox_inches="tight")
+        return output.getvalue()
+    except PlotRenderError:
+        raise
+    except MemoryError:
+        raise PlotRenderError("Plot rendering exceeded the memory limit.")
+    except Exception as e:
+        # the worker's exception types may not be picklable, only the message is sent back
+        raise PlotRenderError(f"{type(e).__name__}: {e}")
+    finally:
+        plt.close("all")
+
+
+class PlotRenderer:
+    def __init__(self, workers=PLOT_WORKERS, cpu_seconds=PLOT_CPU_SECONDS, memory_mb=PLOT_MEMORY_MB,
+                 timeout=PLOT_TIMEOUT, cache_entries=PLOT_CACHE_ENTRIES):
+        self.workers = workers
+        self.cpu_seconds = cpu_seconds
+        self.memory_mb = memory_mb
+        self.timeout = timeout
+        self.cache = MemoryLRU(max_entries=cache_entries)
+        self.hits = 0
+        self.misses = 0
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                # spawn, not fork: the app process is multi-threaded
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(self.memory_mb,),
+                )
+            return self._pool
+
+    def _reset_pool(self, pool):
+        # a hung or crashed worker cannot be reused, the pool is replaced on the next render
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        for process in list((pool._processes or {}).values()):
+            process.terminate()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def render(self, code, df, image_format=PLOT_FORMAT):
+        # returns the image bytes; the same code on the same data is rendered only once
+        arrow_data = dataframe_to_arrow(df)
+        key = hashlib.sha256(code.encode("utf-8") + arrow_data + image_format.encode("utf-8")).hexdigest()
+        image = self.cache.get(key)
+        if image is not _MISSING:
+            self.hits += 1
+            return image
+        self.misses += 1
+
+        pool = self._get_pool()
+        future = pool.submit(_render, code, arrow_data, image_format, self.cpu_seconds)
+        try:
+            image = future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            self._reset_pool(pool)
+            raise PlotRenderError(f"Plot rendering timed out after {self.timeout:.0f}s.")
+        except BrokenProcessPool:
+            self._reset_pool(pool)
+            raise PlotRenderError("The plot worker crashed while rendering.")
+        self.cache.set(key, image)
+        return image
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+plot_renderer = PlotRenderer()
@@ -0,0 +1,54 @@
+import os
+import threading
+from response_cache import MemoryLRU, _MISSING
+
+
+READ_CACHE_ENTRIES = int(os.getenv("READ_CACHE_ENTRIES", "128"))
+
+
+class VersionedReadCache:
+    # results of reads (previews, row counts) keyed by the DDL hash and the write version of every table read;
+    # a write bumps the versions of its tables, so stale entries are never hit again and age out of the LRU.
+    # only writes made by this process are seen, the app is the only writer of its database.
+    # versions are kept per session schema, taken from the engine the read or write goes through
+    def __init__(self, max_entries=READ_CACHE_ENTRIES):
+        self.cache = MemoryLRU(max_entries=max_entries)
+        self.versions = {}
+        self.epochs = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def scope(self, engine):
+        return engine.get_execution_options().get("session_schema")
+
+    def version(self, engine, table):
+        scope = self.scope(engine)
+        with self._lock:
+            return self.epochs.get(scope, 0), self.versions.get((scope, table), 0)
+
+    def bump(self, engine, tables=None):
+        # tables=None: the whole schema changed
+        scope = self.scope(engine)
+        with self._lock:
+            if tables is None:
+                self.epochs[scope] = self.epochs.get(scope, 0) + 1
+                self.versions = {key: version for key, version in self.versions.items() if key[0] != scope}
+                return
+            for table in tables:
+                self.versions[(scope, table)] = self.versions.get((scope, table), 0) + 1
+
+    def get_or_load(self, engine, ddl_hash, key, tables, load):
+        # the versions are taken before loading: a write during the load leaves the result under the old versions
+        cache_key = (self.scope(engine), ddl_hash, key, tuple(self.version(engine, table) for table in tables))
+        value = self.cache.get(cache_key)
+        if value is not _MISSING:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = load()
+        self.cache.set(cache_key, value)
+        return value
+
+
+read_cache = VersionedReadCache()
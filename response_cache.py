@@ -0,0 +1,257 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+CACHE_MODES = ("off", "cache", "record", "replay")
+_MISSING = object()
+
+
+class CacheMissError(LookupError):
+    pass
+
+
+def make_cache_key(kind, model_id, contents, temperature, max_output_tokens):
+    payload = json.dumps(
+        {
+            "kind": kind,
+            "model": model_id,
+            "contents": contents,
+            "temperature": temperature,
+            "max_output_tokens": max_output_tokens,
+        },
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class MemoryLRU:
+    def __init__(self, max_entries=256, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING:
+                return _MISSING
+            value, created_at = item
+            if self.ttl is not None and time.time() - created_at > self.ttl:
+                del self._data[key]
+                self.evictions += 1
+                return _MISSING
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, created_at=None):
+        with self._lock:
+            self._data[key] = (value, created_at if created_at is not None else time.time())
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SqliteStore:
+    def __init__(self, path, max_entries=5000, ttl=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return _MISSING, None
+            value, created_at = row
+            now = time.time()
+            if self.ttl is not None and now - created_at > self.ttl:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._conn.commit()
+                self.evictions += 1
+                return _MISSING, None
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            return json.loads(value), created_at
+
+    def set(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, created_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value, default=str), now, now),
+            )
+            # size eviction: drop least recently used rows above the limit
+            count = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            overflow = count - self.max_entries
+            if overflow > 0:
+                self._conn.execute(
+                    "DELETE FROM responses WHERE key IN "
+                    "(SELECT key FROM responses ORDER BY last_access ASC LIMIT ?)",
+                    (overflow,),
+                )
+                self.evictions += overflow
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+
+
+class ResponseCache:
+    def __init__(self, memory=None, disk=None, mode="cache", max_cacheable_temperature=0.0):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Unknown response cache mode '{mode}'. Expected one of {CACHE_MODES}.")
+        self.memory = memory if memory is not None else MemoryLRU()
+        self.disk = disk
+        self.mode = mode
+        self.max_cacheable_temperature = max_cacheable_temperature
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+
+    @classmethod
+    def from_env(cls):
+        mode = os.getenv("RESPONSE_CACHE_MODE", "cache")
+        ttl = os.getenv("RESPONSE_CACHE_TTL")
+        ttl = float(ttl) if ttl else None
+        memory = MemoryLRU(
+            max_entries=int(os.getenv("RESPONSE_CACHE_MEMORY_ENTRIES", "256")),
+            ttl=ttl,
+        )
+        disk = None
+        path = os.getenv("RESPONSE_CACHE_PATH", os.path.join(".cache", "responses.sqlite"))
+        if mode != "off" and path:
+            disk = SqliteStore(
+                path,
+                max_entries=int(os.getenv("RESPONSE_CACHE_DISK_ENTRIES", "5000")),
+                ttl=ttl,
+            )
+        return cls(
+            memory=memory,
+            disk=disk,
+            mode=mode,
+            max_cacheable_temperature=float(os.getenv("RESPONSE_CACHE_MAX_TEMPERATURE", "0")),
+        )
+
+    def lookup(self, key):
+        value = self.memory.get(key)
+        if value is not _MISSING:
+            return value
+        if self.disk is not None:
+            value, created_at = self.disk.get(key)
+            if value is not _MISSING:
+                # promote to memory keeping the original age for TTL
+                self.memory.set(key, value, created_at=created_at)
+                return value
+        return _MISSING
+
+    def store(self, key, value):
+        self.memory.set(key, value)
+        if self.disk is not None:
+            self.disk.set(key, value)
+
+    def _check(self, key, temperature):
+        # returns (cached value or _MISSING, whether a fresh response should be stored)
+        if self.mode == "off":
+            return _MISSING, False
+
+        if self.mode == "replay":
+            value = self.lookup(key)
+            if value is _MISSING:
+                self.misses += 1
+                raise CacheMissError(f"No recorded response for key {key} (replay mode).")
+            self.hits += 1
+            return value, False
+
+        if self.mode == "cache":
+            if temperature is not None and temperature > self.max_cacheable_temperature:
+                self.bypasses += 1
+                return _MISSING, False
+            value = self.lookup(key)
+            if value is not _MISSING:
+                self.hits += 1
+                return value, False
+
+        # cache miss, or record mode which always goes to the model
+        self.misses += 1
+        return _MISSING, True
+
+    def get_or_call(self, key, temperature, call):
+        value, store = self._check(key, temperature)
+        if value is not _MISSING:
+            return value
+        value = call()
+        if store and value is not None:
+            self.store(key, value)
+        return value
+
+    async def aget_or_call(self, key, temperature, call):
+        value, store = self._check(key, temperature)
+        if value is not _MISSING:
+            return value
+        value = await call()
+        if store and value is not None:
+            self.store(key, value)
+        return value
+
+    def stream_or_call(self, key, temperature, stream):
+        # streaming variant of get_or_call: a cached response is yielded in one piece,
+        # a fresh one chunk by chunk and stored once it is complete
+        value, store = self._check(key, temperature)
+        if value is not _MISSING:
+            yield value
+            return
+        chunks = []
+        for chunk in stream():
+            chunks.append(chunk)
+            yield chunk
+        if store and chunks:
+            self.store(key, "".join(chunks))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "mode": self.mode,
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypasses": self.bypasses,
+            "evictions": self.memory.evictions + (self.disk.evictions if self.disk is not None else 0),
+            "memory_entries": len(self.memory),
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
@@ -0,0 +1,152 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+from ddl_parser import normalize_identifier, strip_comments
+from read_cache import read_cache
+from telemetry import record
+
+
+RESULT_CACHE_BYTES = int(os.getenv("RESULT_CACHE_MB", "64")) * 1024 * 1024
+# a single result above this share of the budget is not cached, it would push out everything else
+RESULT_CACHE_MAX_ENTRY_SHARE = 0.25
+
+# quoted strings and identifiers are kept as they are, everything else is case-insensitive in postgres
+_QUOTED_PATTERN = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")")
+_TABLE_PATTERN = re.compile(r"\b(?:FROM|JOIN)\s+((?:\"[^\"]+\"|[\w.]+)(?:\s+(?:AS\s+)?\w+)?(?:\s*,\s*(?:\"[^\"]+\"|[\w.]+)(?:\s+(?:AS\s+)?\w+)?)*)", re.I)
+_CTE_PATTERN = re.compile(r"(?:\bWITH(?:\s+RECURSIVE)?|,)\s*(\"[^\"]+\"|\w+)\s*(?:\([^)]*\))?\s*AS\s*(?:NOT\s+)?(?:MATERIALIZED\s*)?\(", re.I)
+# results that change without a write, or statements that write
+_UNCACHEABLE_PATTERN = re.compile(
+    r"\b(random|now|clock_timestamp|statement_timestamp|timeofday|current_date|current_time|current_timestamp|"
+    r"localtime|localtimestamp|nextval|currval|setval|pg_\w+|txid_\w+|gen_random_uuid|uuid_generate_\w+|"
+    r"insert|update|delete|merge|into|lock)\b",
+    re.I,
+)
+_SQL_KEYWORDS = {
+    "select", "where", "on", "using", "lateral", "unnest", "join", "inner", "left", "right", "full", "cross",
+    "natural", "group", "order", "limit", "offset", "having", "window", "union", "except", "intersect",
+}
+
+
+def normalize_sql(query):
+    # equivalent spellings of the same query share an entry: comments, whitespace, keyword case, trailing ;
+    parts = _QUOTED_PATTERN.split(strip_comments(query).strip().rstrip(";"))
+    normalized = []
+    for index, part in enumerate(parts):
+        if index % 2:
+            normalized.append(part)
+        else:
+            part = re.sub(r"\s+", " ", part.lower())
+            normalized.append(re.sub(r"\s*([(),=<>+*/-])\s*", r"\1", part))
+    return "".join(normalized).strip()
+
+
+def tables_read(query):
+    # every table in a FROM or JOIN clause, without the query's own CTEs; subqueries are found on their own
+    ctes = {normalize_identifier(name) for name in _CTE_PATTERN.findall(query)}
+    tables = set()
+    for match in _TABLE_PATTERN.finditer(query):
+        for item in match.group(1).split(","):
+            name = item.split()[0]
+            if name.lower() in _SQL_KEYWORDS:
+                continue
+            # schema-qualified names are bumped under the table name
+            name = normalize_identifier(name).split(".")[-1]
+            if name not in ctes:
+                tables.add(name)
+    return tables
+
+
+def is_cacheable(query):
+    return re.match(r"^\s*(SELECT|WITH)\b", query, re.I) is not None and not _UNCACHEABLE_PATTERN.search(query)
+
+
+class ResultCache:
+    # query results as Arrow tables, keyed by the normalized SQL and the write versions (read_cache) of every
+    # table the query reads; inserts, edits and schema changes bump the versions, so stale results are never hit
+    # again and age out of the LRU. the size of the entries is bounded in bytes, not entries
+    def __init__(self, max_bytes=RESULT_CACHE_BYTES, versions=read_cache):
+        self.max_bytes = max_bytes
+        self.versions = versions
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, engine, query, params, max_rows):
+        tables = sorted(tables_read(query))
+        return (
+            self.versions.scope(engine),
+            normalize_sql(query),
+            tuple(sorted((params or {}).items())),
+            max_rows,
+            # every version carries the schema epoch, a query on no table at all still goes with the schema
+            tuple(self.versions.version(engine, table) for table in tables) or self.versions.version(engine, None),
+        )
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            self._data.move_to_end(key)
+            return entry
+
+    def set(self, key, table, attrs):
+        size = table.nbytes
+        if size > self.max_bytes * RESULT_CACHE_MAX_ENTRY_SHARE:
+            return
+        with self._lock:
+            previous = self._data.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[0].nbytes
+            self._data[key] = (table, attrs)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (evicted, _) = self._data.popitem(last=False)
+                self.bytes -= evicted.nbytes
+                self.evictions += 1
+
+    def get_or_run(self, engine, query, params, max_rows, run):
+        # run() returns a DataFrame; the versions are taken before it runs, a write during the query
+        # leaves the result under the old versions
+        if not is_cacheable(query):
+            self.bypasses += 1
+            return run()
+        key = self._key(engine, query, params, max_rows)
+        entry = self.get(key)
+        if entry is not None:
+            self.hits += 1
+            record(result_cache_hits=1)
+            table, attrs = entry
+            df = table.to_pandas()
+            df.attrs.update(attrs)
+            return df
+
+        import pyarrow as pa
+
+        self.misses += 1
+        df = run()
+        try:
+            self.set(key, pa.Table.from_pandas(df, preserve_index=False), dict(df.attrs))
+        except (pa.ArrowException, ValueError, TypeError) as e:
+            # columns Arrow cannot represent (mixed objects, ...) are just not cached
+            print(f"Result not cached: {e}")
+        return df
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def stats(self):
+        return {
+            "entries": len(self._data), "bytes": self.bytes, "hits": self.hits, "misses": self.misses,
+            "bypasses": self.bypasses, "evictions": self.evictions,
+        }
+
+
+result_cache = ResultCache()
@@ -0,0 +1,72 @@
+import hashlib
+import threading
+from sqlalchemy import MetaData, inspect
+
+
+def compute_ddl_hash(ddl_script):
+    return hashlib.sha256(ddl_script.encode('utf-8')).hexdigest()
+
+
+class SchemaCatalog:
+    def __init__(self, engine, ddl_hash=None):
+        self.ddl_hash = ddl_hash
+        # one reflection pass for tables, columns, PKs and FKs, plus the enum types
+        self.metadata = MetaData()
+        self.metadata.reflect(bind=engine)
+        self.enums = {enum["name"]: enum["labels"] for enum in inspect(engine).get_enums()}
+
+        self.tables = dict(self.metadata.tables)
+        self.columns = {}
+        self.primary_keys = {}
+        self.foreign_keys = {}
+        for name, table in self.tables.items():
+            self.columns[name] = {column.name: column.type for column in table.columns}
+            self.primary_keys[name] = [column.name for column in table.primary_key.columns]
+            self.foreign_keys[name] = [
+                {
+                    "column": fk.parent.name,
+                    "ref_table": fk.column.table.name,
+                    "ref_column": fk.column.name,
+                }
+                for fk in table.foreign_keys
+            ]
+
+    @property
+    def table_names(self):
+        return list(self.tables)
+
+    def has_table(self, table_name):
+        return table_name in self.tables
+
+    def column_names(self, table_name):
+        return list(self.columns.get(table_name, {}))
+
+
+_catalogs = {}
+_lock = threading.Lock()
+
+
+def _catalog_key(engine):
+    # sessions share the pool but not their schema
+    return str(engine.url), engine.get_execution_options().get("session_schema")
+
+
+def refresh_schema_catalog(engine, ddl_hash=None):
+    catalog = SchemaCatalog(engine, ddl_hash)
+    with _lock:
+        _catalogs[_catalog_key(engine)] = catalog
+    return catalog
+
+
+def get_schema_catalog(engine, ddl_hash=None):
+    # reflected once per DDL hash, later calls are served from memory
+    with _lock:
+        catalog = _catalogs.get(_catalog_key(engine))
+    if catalog is None or catalog.ddl_hash != ddl_hash:
+        catalog = refresh_schema_catalog(engine, ddl_hash)
+    return catalog
+
+
+def invalidate_schema_catalog(engine):
+    with _lock:
+        _catalogs.pop(_catalog_key(engine), None)
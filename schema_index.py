@@ -0,0 +1,174 @@
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter
+from ddl_parser import alter_target, parse_ddl
+from schema_catalog import compute_ddl_hash
+from conversation_context import estimate_tokens
+
+
+SCHEMA_PRUNING_MIN_TABLES = int(os.getenv("SCHEMA_PRUNING_MIN_TABLES", "6"))
+SCHEMA_PRUNING_MAX_TABLES = int(os.getenv("SCHEMA_PRUNING_MAX_TABLES", "8"))
+# tables scoring below this share of the best match are dropped
+SCHEMA_PRUNING_SCORE_RATIO = 0.4
+BM25_K1 = 1.2
+BM25_B = 0.75
+# the table name counts more than a column name
+TABLE_NAME_WEIGHT = 3
+
+
+def tokenize(text):
+    # snake_case and camelCase identifiers are split into words, plurals and -ing/-ed endings are stripped
+    text = re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", str(text))
+    tokens = []
+    for word in re.findall(r"[a-z0-9]+", text.lower()):
+        if len(word) > 3 and word.endswith("ies"):
+            word = word[:-3] + "y"
+        elif len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        elif len(word) > 4 and word.endswith(("ing", "ed")):
+            word = word[:-3] if word.endswith("ing") else word[:-2]
+        tokens.append(word)
+    return tokens
+
+
+class SchemaIndex:
+    def __init__(self, ddl_schema):
+        self.ddl_schema = ddl_schema
+        self.schema = parse_ddl(ddl_schema)
+        self.full_tokens = estimate_tokens(ddl_schema)
+
+        # one document per table: its name, columns, types, enum labels and referenced tables
+        self.documents = {}
+        for name, table in self.schema.tables.items():
+            terms = tokenize(name) * TABLE_NAME_WEIGHT
+            for column in table.columns.values():
+                terms.extend(tokenize(column.name))
+                if column.base_type in self.schema.enums:
+                    terms.extend(tokenize(column.base_type))
+                    for label in self.schema.enums[column.base_type]:
+                        terms.extend(tokenize(label))
+            for foreign_key in table.foreign_keys:
+                terms.extend(tokenize(foreign_key.ref_table))
+            self.documents[name] = Counter(terms)
+
+        self.average_length = sum(sum(doc.values()) for doc in self.documents.values()) / max(len(self.documents), 1)
+        document_frequency = Counter(term for doc in self.documents.values() for term in doc)
+        count = len(self.documents)
+        self.idf = {
+            term: math.log(1 + (count - frequency + 0.5) / (frequency + 0.5))
+            for term, frequency in document_frequency.items()
+        }
+
+        # FK neighbourhood: referenced parents, and links in both directions
+        self.parents = {name: set() for name in self.schema.tables}
+        self.neighbours = {name: set() for name in self.schema.tables}
+        for name, table in self.schema.tables.items():
+            for foreign_key in table.foreign_keys:
+                if foreign_key.ref_table in self.neighbours and foreign_key.ref_table != name:
+                    self.parents[name].add(foreign_key.ref_table)
+                    self.neighbours[name].add(foreign_key.ref_table)
+                    self.neighbours[foreign_key.ref_table].add(name)
+
+    def score(self, question):
+        terms = set(tokenize(question))
+        scores = {}
+        for name, doc in self.documents.items():
+            length = sum(doc.values())
+            score = 0.0
+            for term in terms:
+                frequency = doc.get(term, 0)
+                if not frequency:
+                    continue
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * length / self.average_length)
+                score += self.idf[term] * frequency * (BM25_K1 + 1) / (frequency + norm)
+            if score > 0:
+                scores[name] = score
+        return scores
+
+    def relevant_tables(self, question, max_tables=SCHEMA_PRUNING_MAX_TABLES):
+        scores = self.score(question)
+        if not scores:
+            return None
+        best = max(scores.values())
+        ranked = sorted(
+            (name for name, score in scores.items() if score >= best * SCHEMA_PRUNING_SCORE_RATIO),
+            key=lambda name: -scores[name],
+        )[:max_tables]
+
+        # tables needed to answer about the best match: the parents it references (for names/labels)
+        # and any table bridging two matched tables
+        selected = set(ranked)
+        for parent in sorted(self.parents[ranked[0]]):
+            if len(selected) >= max_tables:
+                break
+            selected.add(parent)
+        for name in self.schema.tables:
+            if name not in selected and len(self.neighbours[name] & set(ranked)) >= 2 and len(selected) < max_tables:
+                selected.add(name)
+        return [name for name in self.schema.tables if name in selected]
+
+    def sub_schema(self, tables):
+        parts = []
+        enums = []
+        for name in tables:
+            for column in self.schema.tables[name].columns.values():
+                if column.base_type in self.schema.enums and column.base_type not in enums:
+                    enums.append(column.base_type)
+        parts.extend(self.schema.enum_ddl(enum) for enum in enums)
+        parts.extend(self.schema.tables[name].statement for name in tables)
+        parts.extend(
+            stmt for stmt in self.schema.statements
+            if stmt.upper().startswith("ALTER TABLE") and alter_target(stmt) in tables
+        )
+        return ";\n".join(parts) + ";"
+
+    def prune(self, question):
+        # returns (ddl for the prompt, stats); small schemas and questions matching nothing keep the full DDL
+        start = time.perf_counter()
+        tables = None
+        if len(self.schema.tables) >= SCHEMA_PRUNING_MIN_TABLES:
+            tables = self.relevant_tables(question)
+        ddl = self.ddl_schema if not tables or len(tables) == len(self.schema.tables) else self.sub_schema(tables)
+        tokens = estimate_tokens(ddl)
+        stats = {
+            "tables": tables or list(self.schema.tables),
+            "total_tables": len(self.schema.tables),
+            "tokens": tokens,
+            "tokens_saved": self.full_tokens - tokens,
+            "seconds": time.perf_counter() - start,
+        }
+        return ddl, stats
+
+
+_indexes = {}
+_lock = threading.Lock()
+MAX_INDEXES = 16
+
+
+def get_schema_index(ddl_schema, ddl_hash=None):
+    # built once per DDL hash
+    ddl_hash = ddl_hash or compute_ddl_hash(ddl_schema)
+    with _lock:
+        index = _indexes.get(ddl_hash)
+    if index is None:
+        index = SchemaIndex(ddl_schema)
+        with _lock:
+            if len(_indexes) >= MAX_INDEXES:
+                _indexes.pop(next(iter(_indexes)))
+            _indexes[ddl_hash] = index
+    return index
+
+
+def prune_schema(ddl_schema, question, ddl_hash=None):
+    try:
+        index = get_schema_index(ddl_schema, ddl_hash)
+    except Exception as e:
+        print(f"Schema index unavailable, using the full DDL: {e}")
+        return ddl_schema, None
+    ddl, stats = index.prune(question)
+    print(f"Schema pruning: {len(stats['tables'])}/{stats['total_tables']} tables, "
+          f"~{stats['tokens']} tokens (saved ~{stats['tokens_saved']}) in {stats['seconds'] * 1000:.1f} ms")
+    return ddl, stats
@@ -0,0 +1,304 @@
+import re
+import time
+import uuid
+from collections import OrderedDict
+from sqlalchemy import text
+from ddl_parser import quote_identifier, split_sql_statements
+
+
+SERIAL_TYPES = {"integer": "serial", "bigint": "bigserial", "smallint": "smallserial"}
+# constraints are added in this order, foreign keys last because they need the referenced keys
+CONSTRAINT_ORDER = {"p": 0, "u": 1, "x": 2, "c": 3, "f": 4}
+OLD_ENUM_SUFFIX = "__old"
+
+_TABLES_QUERY = """
+    SELECT c.relname
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = :schema AND c.relkind IN ('r', 'p')
+    ORDER BY c.oid
+"""
+_COLUMNS_QUERY = """
+    SELECT c.relname, a.attname, format_type(a.atttypid, a.atttypmod), a.attnotnull,
+           pg_get_expr(d.adbin, d.adrelid), a.attidentity, a.attgenerated
+    FROM pg_attribute a
+    JOIN pg_class c ON c.oid = a.attrelid
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    LEFT JOIN pg_attrdef d ON d.adrelid = a.attrelid AND d.adnum = a.attnum
+    WHERE n.nspname = :schema AND c.relkind IN ('r', 'p') AND a.attnum > 0 AND NOT a.attisdropped
+    ORDER BY c.relname, a.attnum
+"""
+_CONSTRAINTS_QUERY = """
+    SELECT c.relname, k.conname, k.contype, pg_get_constraintdef(k.oid)
+    FROM pg_constraint k
+    JOIN pg_class c ON c.oid = k.conrelid
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = :schema AND k.contype IN ('p', 'u', 'x', 'c', 'f')
+    ORDER BY k.oid
+"""
+# indexes that do not back a constraint, i.e. CREATE INDEX statements
+_INDEXES_QUERY = """
+    SELECT c.relname, i.relname, pg_get_indexdef(x.indexrelid)
+    FROM pg_index x
+    JOIN pg_class i ON i.oid = x.indexrelid
+    JOIN pg_class c ON c.oid = x.indrelid
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = :schema
+      AND NOT EXISTS (SELECT 1 FROM pg_constraint k WHERE k.conindid = x.indexrelid AND k.conrelid = x.indrelid)
+    ORDER BY i.oid
+"""
+_ENUMS_QUERY = """
+    SELECT t.typname, array_agg(e.enumlabel ORDER BY e.enumsortorder)
+    FROM pg_type t
+    JOIN pg_enum e ON e.enumtypid = t.oid
+    JOIN pg_namespace n ON n.oid = t.typnamespace
+    WHERE n.nspname = :schema
+    GROUP BY t.typname
+"""
+_INDEX_TARGET = re.compile(r" ON (ONLY )?(\"[^\"]*\"|[\w$]+)\.(\"[^\"]*\"|[\w$]+) USING ")
+
+
+class SchemaSnapshot:
+    # tables, columns, constraints, indexes and enums of one Postgres schema, as Postgres itself prints them
+    def __init__(self, conn, schema):
+        # names are printed unqualified only when the schema is on the search path
+        conn.execute(text("SELECT set_config('search_path', :path, true)"), {"path": quote_identifier(schema)})
+        params = {"schema": schema}
+        self.tables = OrderedDict((row[0], OrderedDict()) for row in conn.execute(text(_TABLES_QUERY), params))
+        for table, name, data_type, not_null, default, identity, generated in conn.execute(text(_COLUMNS_QUERY), params):
+            self.tables[table][name] = {
+                "type": data_type, "not_null": not_null, "default": default,
+                "identity": identity or "", "generated": generated or "",
+            }
+        self.constraints = OrderedDict()
+        for table, name, kind, definition in conn.execute(text(_CONSTRAINTS_QUERY), params):
+            self.constraints[(table, definition)] = {"table": table, "name": name, "kind": kind, "definition": definition}
+        self.indexes = OrderedDict()
+        for table, name, definition in conn.execute(text(_INDEXES_QUERY), params):
+            # the index name is not part of the key, a renamed but otherwise equal index is kept
+            key = (table, definition.startswith("CREATE UNIQUE"), definition.split(" USING ", 1)[-1])
+            self.indexes[key] = {"table": table, "name": name, "definition": definition}
+        self.enums = {name: list(labels) for name, labels in conn.execute(text(_ENUMS_QUERY), params)}
+
+
+class MigrationPlan:
+    def __init__(self):
+        self.statements = []
+        self.changes = []
+        self.kept_tables = []
+        self.seconds = 0.0
+
+    def add(self, statement, change=None):
+        self.statements.append(statement)
+        if change:
+            self.changes.append(change)
+
+    def summary(self):
+        lines = list(self.changes) or ["Schema is already up to date."]
+        lines.append(f"{len(self.statements)} statements, {len(self.kept_tables)} tables kept their data "
+                     f"({self.seconds * 1000:.0f} ms)")
+        return lines
+
+
+def ddl_statements(ddl_script):
+    # CREATE TYPE / CREATE TABLE / ... first, foreign keys added by ALTER TABLE once every table exists
+    creation_statements = []
+    fk_statements = []
+    for statement in split_sql_statements(ddl_script):
+        if statement.upper().startswith("ALTER TABLE") and "FOREIGN KEY" in statement.upper():
+            fk_statements.append(statement)
+        else:
+            creation_statements.append(statement)
+    return creation_statements + fk_statements
+
+
+def _column_definition(name, column):
+    definition = f"{quote_identifier(name)} {column['type']}"
+    default = column["default"]
+    if column["generated"] == "s":
+        return f"{definition} GENERATED ALWAYS AS ({default}) STORED"
+    if column["identity"]:
+        kind = "ALWAYS" if column["identity"] == "a" else "BY DEFAULT"
+        return f"{definition} GENERATED {kind} AS IDENTITY"
+    if default and default.startswith("nextval(") and column["type"] in SERIAL_TYPES:
+        # the sequence of a serial column is created together with the column
+        return f"{quote_identifier(name)} {SERIAL_TYPES[column['type']]}"
+    if default:
+        definition += f" DEFAULT {default}"
+    if column["not_null"]:
+        definition += " NOT NULL"
+    return definition
+
+
+def _type_change(table, name, column, enum_targets):
+    cast = f"{quote_identifier(name)}::text::{column['type']}" if column["type"] in enum_targets \
+        else f"{quote_identifier(name)}::{column['type']}"
+    return f"ALTER TABLE {table} ALTER COLUMN {quote_identifier(name)} TYPE {column['type']} USING {cast}"
+
+
+def _set_default(plan, table_name, name, column):
+    table = quote_identifier(table_name)
+    default = column["default"]
+    sequence = re.match(r"nextval\('([^']+)'::regclass\)", default or "")
+    if sequence:
+        # a column that becomes serial needs its sequence, started after the existing values
+        plan.add(f"CREATE SEQUENCE IF NOT EXISTS {sequence.group(1)} OWNED BY {table}.{quote_identifier(name)}")
+        plan.add(f"SELECT setval('{sequence.group(1)}', COALESCE((SELECT MAX({quote_identifier(name)}) FROM {table}), 0) + 1, false)")
+    plan.add(f"ALTER TABLE {table} ALTER COLUMN {quote_identifier(name)} SET DEFAULT {default}")
+
+
+def _alter_column(plan, table_name, name, live, target, recreated_enums, enum_targets):
+    table = quote_identifier(table_name)
+    column = quote_identifier(name)
+    changes = []
+    type_changed = live["type"] != target["type"] or live["type"] in recreated_enums
+    default_changed = live["default"] != target["default"] or (type_changed and live["default"])
+    if live["identity"] and live["identity"] != target["identity"]:
+        plan.add(f"ALTER TABLE {table} ALTER COLUMN {column} DROP IDENTITY IF EXISTS")
+    # the old default may not cast to the new type, it is dropped first and set again afterwards
+    if default_changed and live["default"] and not live["identity"]:
+        plan.add(f"ALTER TABLE {table} ALTER COLUMN {column} DROP DEFAULT")
+    if type_changed:
+        plan.add(_type_change(table, name, target, enum_targets))
+        changes.append(f"type {live['type']} -> {target['type']}" if live["type"] != target["type"]
+                       else f"{target['type']} values")
+    if default_changed and target["default"] and not target["identity"]:
+        _set_default(plan, table_name, name, target)
+    if live["default"] != target["default"]:
+        changes.append("default")
+    if target["identity"] and live["identity"] != target["identity"]:
+        kind = "ALWAYS" if target["identity"] == "a" else "BY DEFAULT"
+        plan.add(f"ALTER TABLE {table} ALTER COLUMN {column} ADD GENERATED {kind} AS IDENTITY")
+        changes.append("identity")
+    if live["not_null"] != target["not_null"]:
+        plan.add(f"ALTER TABLE {table} ALTER COLUMN {column} {'SET' if target['not_null'] else 'DROP'} NOT NULL")
+        changes.append("NOT NULL" if target["not_null"] else "nullable")
+    if changes:
+        plan.changes.append(f"Altered column {table_name}.{name}: {', '.join(changes)}")
+
+
+def _regenerated(live, target):
+    # generated columns hold no data of their own, a changed expression is dropped and added again
+    return live["generated"] != target["generated"] or (target["generated"] and live["default"] != target["default"])
+
+
+def plan_migration(live, target, schema):
+    # statements that turn the live snapshot into the target one; tables and columns are matched by name,
+    # so a renamed column is dropped and added again
+    plan = MigrationPlan()
+    kept_tables = [name for name in target.tables if name in live.tables]
+    plan.kept_tables = kept_tables
+    dropped_tables = [name for name in live.tables if name not in target.tables]
+    new_enums = [name for name in target.enums if name not in live.enums]
+    recreated_enums = [name for name in target.enums if name in live.enums and live.enums[name] != target.enums[name]]
+    dropped_enums = [name for name in live.enums if name not in target.enums]
+
+    # 1. constraints and indexes that are gone or changed, foreign keys first
+    removed_constraints = [
+        constraint for key, constraint in live.constraints.items()
+        if key not in target.constraints and constraint["table"] not in dropped_tables
+    ]
+    for constraint in sorted(removed_constraints, key=lambda c: -CONSTRAINT_ORDER[c["kind"]]):
+        plan.add(
+            f"ALTER TABLE {quote_identifier(constraint['table'])} DROP CONSTRAINT IF EXISTS {quote_identifier(constraint['name'])}",
+            f"Dropped constraint {constraint['table']}: {constraint['definition']}",
+        )
+    for key, index in live.indexes.items():
+        if key not in target.indexes and index["table"] not in dropped_tables:
+            plan.add(f"DROP INDEX IF EXISTS {quote_identifier(schema)}.{quote_identifier(index['name'])}",
+                     f"Dropped index {index['name']}")
+
+    # 2. tables that are no longer in the DDL, in one statement so references between them do not matter
+    if dropped_tables:
+        plan.add(f"DROP TABLE {', '.join(quote_identifier(name) for name in dropped_tables)} CASCADE",
+                 f"Dropped tables: {', '.join(dropped_tables)}")
+
+    # 3. enums; an enum whose labels changed is created again and its columns are cast through text
+    for name in recreated_enums:
+        plan.add(f"ALTER TYPE {quote_identifier(name)} RENAME TO {quote_identifier(name + OLD_ENUM_SUFFIX)}")
+    for name in new_enums + recreated_enums:
+        labels = ", ".join("'" + label.replace("'", "''") + "'" for label in target.enums[name])
+        plan.add(f"CREATE TYPE {quote_identifier(name)} AS ENUM ({labels})",
+                 f"{'Created' if name in new_enums else 'Changed'} enum {name}")
+
+    # 4. new tables, their keys are added together with all other constraints
+    for name, columns in target.tables.items():
+        if name not in live.tables:
+            definitions = ",\n    ".join(_column_definition(column, info) for column, info in columns.items())
+            plan.add(f"CREATE TABLE {quote_identifier(name)} (\n    {definitions}\n)", f"Created table {name}")
+
+    # 5. columns of the tables that keep their data
+    enum_targets = set(target.enums)
+    for name in kept_tables:
+        live_columns, target_columns = live.tables[name], target.tables[name]
+        table = quote_identifier(name)
+        for column, info in live_columns.items():
+            if column not in target_columns or _regenerated(info, target_columns[column]):
+                plan.add(f"ALTER TABLE {table} DROP COLUMN {quote_identifier(column)} CASCADE",
+                         f"Dropped column {name}.{column}")
+        for column, info in target_columns.items():
+            live_info = live_columns.get(column)
+            if live_info is None or _regenerated(live_info, info):
+                plan.add(f"ALTER TABLE {table} ADD COLUMN {_column_definition(column, info)}",
+                         f"Added column {name}.{column} {info['type']}")
+            else:
+                _alter_column(plan, name, column, live_info, info, recreated_enums, enum_targets)
+
+    for name in dropped_enums + [name + OLD_ENUM_SUFFIX for name in recreated_enums]:
+        plan.add(f"DROP TYPE IF EXISTS {quote_identifier(name)}",
+                 f"Dropped enum {name}" if name in dropped_enums else None)
+
+    # 6. new and changed constraints and indexes
+    added_constraints = [constraint for key, constraint in target.constraints.items() if key not in live.constraints]
+    for constraint in sorted(added_constraints, key=lambda c: CONSTRAINT_ORDER[c["kind"]]):
+        plan.add(
+            f"ALTER TABLE {quote_identifier(constraint['table'])} ADD CONSTRAINT {quote_identifier(constraint['name'])} "
+            f"{constraint['definition']}",
+            f"Added constraint {constraint['table']}: {constraint['definition']}"
+            if constraint["table"] in live.tables else None,
+        )
+    for key, index in target.indexes.items():
+        if key not in live.indexes:
+            definition = _INDEX_TARGET.sub(
+                lambda match: f" ON {match.group(1) or ''}{quote_identifier(schema)}.{match.group(3)} USING ",
+                index["definition"], count=1,
+            )
+            plan.add(definition, f"Created index {index['name']}")
+    return plan
+
+
+def _execute(conn, statement):
+    # no bind parameters in DDL: ':' must not start one, '%' is escaped for the driver
+    conn.exec_driver_sql(statement.replace("%", "%%"))
+
+
+def migrate_schema(engine, ddl_script, dry_run=False):
+    # the new DDL is run in a scratch schema, Postgres reflects both and only the difference is applied;
+    # everything happens in one transaction, a failing statement leaves the database untouched
+    start = time.perf_counter()
+    scratch = f"_migration_{uuid.uuid4().hex[:12]}"
+    with engine.connect() as conn:
+        transaction = conn.begin()
+        try:
+            schema = conn.execute(text("SELECT current_schema()")).scalar()
+            conn.execute(text(f"CREATE SCHEMA {scratch}"))
+            conn.execute(text("SELECT set_config('search_path', :path, true)"), {"path": scratch})
+            for statement in ddl_statements(ddl_script):
+                _execute(conn, statement)
+            target = SchemaSnapshot(conn, scratch)
+            live = SchemaSnapshot(conn, schema)
+            conn.execute(text(f"DROP SCHEMA {scratch} CASCADE"))
+
+            plan = plan_migration(live, target, schema)
+            # the live snapshot left the search path on the live schema
+            for statement in plan.statements:
+                _execute(conn, statement)
+            plan.seconds = time.perf_counter() - start
+            if dry_run:
+                transaction.rollback()
+            else:
+                transaction.commit()
+        except Exception:
+            transaction.rollback()
+            raise
+    return plan
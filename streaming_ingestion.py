@@ -0,0 +1,191 @@
+import contextvars
+import os
+import queue
+import threading
+import time
+from bulk_ingestion import IngestionReport, ingest_sql_script
+
+
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", "64"))
+# statements already waiting in the queue are loaded together, up to this many
+STREAM_BATCH_STATEMENTS = int(os.getenv("STREAM_BATCH_STATEMENTS", "50"))
+
+_DONE = object()
+
+
+class StatementSplitter:
+    # cuts complete SQL statements off a text stream; semicolons inside string literals,
+    # quoted identifiers and comments do not end a statement
+    def __init__(self):
+        self.buffer = ""
+        self.position = 0
+        self.quote = None
+        self.comment = None
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        statements = []
+        start = 0
+        index = self.position
+        buffer = self.buffer
+        while index < len(buffer):
+            char = buffer[index]
+            if self.comment == "--":
+                if char == "\n":
+                    self.comment = None
+            elif self.comment == "/*":
+                if buffer.startswith("*/", index):
+                    self.comment = None
+                    index += 1
+            elif self.quote:
+                # a doubled quote is an escaped quote, which this toggling handles as close + reopen
+                if char == self.quote:
+                    self.quote = None
+            elif char in "'\"":
+                self.quote = char
+            elif char in "-/" and index + 1 >= len(buffer):
+                # may be the start of a comment whose second character is still on its way
+                break
+            elif buffer.startswith("--", index) or buffer.startswith("/*", index):
+                self.comment = buffer[index:index + 2]
+                index += 1
+            elif char == ";":
+                statement = _clean(buffer[start:index])
+                if statement:
+                    statements.append(statement)
+                start = index + 1
+            index += 1
+        self.buffer = buffer[start:]
+        self.position = index - start
+        return statements
+
+    def flush(self):
+        statement = _clean(self.buffer)
+        self.buffer = ""
+        self.position = 0
+        return [statement] if statement else []
+
+
+def _clean(statement):
+    # the model may wrap its answer in a ```sql fence
+    lines = [line for line in statement.splitlines() if not line.strip().startswith("```")]
+    return "\n".join(lines).strip()
+
+
+def complete_statements(text):
+    # a response cut off by max_output_tokens ends in the middle of a statement; returns the complete statements
+    # and the truncated tail that was dropped ("" when nothing was cut off)
+    splitter = StatementSplitter()
+    statements = splitter.feed(text)
+    tail, truncated = _finish(splitter)
+    return statements + tail, truncated
+
+
+def _finish(splitter):
+    # what is left in the splitter at the end of the text: (last statement, []) or ([], truncated tail)
+    if splitter.quote or splitter.comment == "/*":
+        return [], splitter.buffer.strip()
+    tail = splitter.flush()
+    if not tail:
+        return [], ""
+    # the last statement may just be missing its semicolon: kept unless a parenthesis is still open
+    if _open_parentheses(tail[0]):
+        return [], tail[0]
+    return tail, ""
+
+
+def _open_parentheses(statement):
+    depth = 0
+    quote = None
+    for char in statement:
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in "'\"":
+            quote = char
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+    return depth > 0
+
+
+def stream_into_database(chunks, engine, catalog=None, on_progress=None,
+                         queue_size=STREAM_QUEUE_SIZE, batch_statements=STREAM_BATCH_STATEMENTS):
+    # statements are split off the stream as it arrives and loaded by a background worker,
+    # so the model keeps generating while earlier statements are inserted;
+    # on_progress(rows_by_table, timings) is called from this thread only
+    start = time.perf_counter()
+    statements = queue.Queue(maxsize=queue_size)
+    report = IngestionReport()
+    lock = threading.Lock()
+    timings = {"first_row_seconds": None, "statements": 0, "truncated": ""}
+    errors = []
+
+    def load(batch):
+        try:
+            part = ingest_sql_script(engine, ";\n".join(batch), catalog=catalog)
+        except Exception as e:
+            errors.append(e)
+            return
+        with lock:
+            report.merge(part)
+            timings["statements"] += len(batch)
+            if timings["first_row_seconds"] is None and part.inserted_rows:
+                timings["first_row_seconds"] = time.perf_counter() - start
+
+    def worker():
+        finished = False
+        while not finished:
+            batch = []
+            item = statements.get()
+            while item is not _DONE:
+                batch.append(item)
+                if len(batch) >= batch_statements:
+                    break
+                try:
+                    item = statements.get_nowait()
+                except queue.Empty:
+                    break
+            finished = item is _DONE
+            # after an error the rest of the stream is only drained, so the producer never blocks
+            if batch and not errors:
+                load(batch)
+
+    def progress():
+        if on_progress is not None:
+            with lock:
+                rows_by_table = {table: stats["rows"] for table, stats in report.tables.items()}
+                current = dict(timings, seconds=time.perf_counter() - start)
+            on_progress(rows_by_table, current)
+
+    # the worker runs in a copy of the caller's context so its spans join the current request trace
+    thread = threading.Thread(target=contextvars.copy_context().run, args=(worker,), name="stream-insert-worker", daemon=True)
+    thread.start()
+    splitter = StatementSplitter()
+    try:
+        for chunk in chunks:
+            for statement in splitter.feed(chunk):
+                statements.put(statement)
+            progress()
+        # a stream cut off by max_output_tokens ends in the middle of a statement, that tail is dropped
+        tail, truncated = _finish(splitter)
+        for statement in tail:
+            statements.put(statement)
+        timings["truncated"] = truncated
+    finally:
+        statements.put(_DONE)
+        while thread.is_alive():
+            thread.join(0.2)
+            progress()
+
+    if errors:
+        raise errors[0]
+    timings["seconds"] = time.perf_counter() - start
+    for line in report.summary():
+        print(line)
+    if timings["truncated"]:
+        print(f"Dropped truncated statement ({len(timings['truncated'])} characters), raise max_output_tokens")
+    print(f"Streamed {timings['statements']} statements, first row after "
+          f"{timings['first_row_seconds'] or 0:.2f}s, total {timings['seconds']:.2f}s")
+    return report, timings
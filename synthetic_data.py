@@ -0,0 +1,405 @@
+import io
+import os
+import re
+import time
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+from ddl_parser import parse_ddl, dependency_levels, quote_identifier
+from read_cache import read_cache
+
+
+SYNTHETIC_CHUNK_ROWS = int(os.getenv("SYNTHETIC_CHUNK_ROWS", "50000"))
+DEFAULT_NULL_FRACTION = 0.1
+MAX_SAMPLED_PARENT_KEYS = 100000
+
+FIRST_NAMES = np.array([
+    "James", "Mary", "John", "Patricia", "Robert", "Jennifer", "Michael", "Linda", "William", "Elizabeth",
+    "David", "Barbara", "Richard", "Susan", "Joseph", "Jessica", "Thomas", "Sarah", "Charles", "Karen",
+    "Anna", "Piotr", "Monika", "Lukas", "Sofia", "Mateo", "Aiko", "Chen", "Priya", "Omar",
+])
+LAST_NAMES = np.array([
+    "Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia", "Miller", "Davis", "Rodriguez", "Martinez",
+    "Hernandez", "Lopez", "Gonzalez", "Wilson", "Anderson", "Thomas", "Taylor", "Moore", "Jackson", "Martin",
+    "Nowak", "Kowalski", "Muller", "Rossi", "Tanaka", "Wang", "Patel", "Khan", "Silva", "Dubois",
+])
+CITIES = np.array([
+    "New York", "Los Angeles", "Chicago", "Houston", "Phoenix", "Philadelphia", "San Antonio", "San Diego",
+    "Dallas", "Austin", "Seattle", "Denver", "Boston", "Portland", "Atlanta", "Miami",
+])
+STATES = np.array(["NY", "CA", "IL", "TX", "AZ", "PA", "WA", "CO", "MA", "OR", "GA", "FL"])
+COUNTRIES = np.array(["USA", "Canada", "United Kingdom", "Germany", "France", "Poland", "Japan", "Brazil", "India"])
+STREETS = np.array(["Main St", "Oak Ave", "Pine Rd", "Maple Dr", "Cedar Ln", "Elm St", "Lake View", "Hill Rd"])
+WORDS = np.array([
+    "alpha", "bright", "central", "data", "global", "harbor", "summit", "urban", "vertex", "prime",
+    "river", "north", "quick", "solid", "green", "open", "silver", "blue", "united", "future",
+])
+
+_BASE_DATE = np.datetime64("2015-01-01")
+_DATE_SPAN_DAYS = 365 * 10
+
+_RANGE_PATTERNS = [
+    (re.compile(r"^\s*(\w+)\s*>=\s*(-?[\d.]+)\s*$"), "min", 0),
+    (re.compile(r"^\s*(\w+)\s*>\s*(-?[\d.]+)\s*$"), "min", 1),
+    (re.compile(r"^\s*(\w+)\s*<=\s*(-?[\d.]+)\s*$"), "max", 0),
+    (re.compile(r"^\s*(\w+)\s*<\s*(-?[\d.]+)\s*$"), "max", -1),
+]
+
+
+def parse_check_bounds(checks):
+    # {column: {"min": ..., "max": ..., "values": [...]}} for the simple single-column CHECKs
+    bounds = {}
+    for check in checks:
+        for clause in re.split(r"\s+AND\s+", check.strip("() "), flags=re.I):
+            clause = clause.strip("() ")
+            between = re.match(r"^(\w+)\s+BETWEEN\s+(-?[\d.]+)\s+AND\s+(-?[\d.]+)$", clause, re.I)
+            if between:
+                column_bounds = bounds.setdefault(between.group(1).lower(), {})
+                column_bounds["min"] = float(between.group(2))
+                column_bounds["max"] = float(between.group(3))
+                continue
+            values = re.match(r"^(\w+)\s+IN\s*\((.*)\)$", clause, re.I)
+            if values:
+                bounds.setdefault(values.group(1).lower(), {})["values"] = [
+                    value.strip().strip("'") for value in values.group(2).split(",")
+                ]
+                continue
+            for pattern, key, offset in _RANGE_PATTERNS:
+                match = pattern.match(clause)
+                if match:
+                    bounds.setdefault(match.group(1).lower(), {})[key] = float(match.group(2)) + offset
+                    break
+    return bounds
+
+
+def _with_nulls(values, null_fraction, rng, fill=None):
+    if null_fraction <= 0:
+        return values
+    values = pd.Series(values, dtype=object)
+    mask = rng.random(len(values)) < null_fraction
+    values[mask] = fill
+    return values
+
+
+def _numeric_values(column, n, rng, bounds, distribution, is_integer):
+    scale = column.type_args[1] if len(column.type_args) > 1 else (0 if is_integer else 2)
+    type_limit = 10 ** (column.type_args[0] - scale) - 1 if column.type_args and not is_integer else 2 ** 31 - 1
+    # without a suggested distribution keep values in a small readable range
+    default_high = type_limit if "type" in distribution else (1000 if is_integer else 10000)
+    low = bounds.get("min", distribution.get("min", 1 if is_integer else 0))
+    high = min(bounds.get("max", distribution.get("max", default_high)), type_limit)
+
+    kind = distribution.get("type", "uniform")
+    if kind == "normal":
+        values = rng.normal(distribution.get("mean", (low + high) / 2), distribution.get("std", (high - low) / 6), n)
+    elif kind == "lognormal":
+        values = rng.lognormal(distribution.get("mean", 0.0), distribution.get("sigma", 1.0), n)
+    elif kind == "exponential":
+        values = low + rng.exponential(distribution.get("scale", (high - low) / 4), n)
+    else:
+        values = rng.uniform(low, high + (1 if is_integer else 0), n)
+    values = np.clip(values, low, high)
+    if is_integer:
+        return np.floor(values).astype(np.int64)
+    return np.round(values, scale)
+
+
+def _string_values(column, table_name, n, row_index, rng):
+    name = column.name.lower()
+    if "email" in name:
+        values = np.char.add(
+            np.char.add(np.char.lower(rng.choice(FIRST_NAMES, n)), "."),
+            np.char.add(row_index.astype(str), "@example.com"),
+        )
+    elif "first_name" in name:
+        values = rng.choice(FIRST_NAMES, n)
+    elif "last_name" in name or "surname" in name:
+        values = rng.choice(LAST_NAMES, n)
+    elif "middle_name" in name:
+        values = rng.choice(FIRST_NAMES, n)
+    elif "phone" in name:
+        values = np.char.add("555-", np.char.zfill(rng.integers(0, 10 ** 7, n).astype(str), 7))
+    elif "zip" in name or "postal" in name:
+        values = np.char.zfill(rng.integers(0, 10 ** 5, n).astype(str), 5)
+    elif name == "city" or name.endswith("_city"):
+        values = rng.choice(CITIES, n)
+    elif name == "state" or name.endswith("_state"):
+        values = rng.choice(STATES, n)
+    elif "country" in name or "nationality" in name:
+        values = rng.choice(COUNTRIES, n)
+    elif "address" in name:
+        values = np.char.add(np.char.add(rng.integers(1, 9999, n).astype(str), " "), rng.choice(STREETS, n))
+    elif "website" in name or "url" in name:
+        values = np.char.add(np.char.add("https://www.", rng.choice(WORDS, n)), ".example.com")
+    elif "isbn" in name or "license" in name or "code" in name:
+        values = np.char.add(name[:3].upper() + "-", np.char.zfill(row_index.astype(str), 9))
+    else:
+        label = re.sub(r"ies$", "y", table_name)
+        label = (label[:-1] if label.endswith("s") else label).replace("_", " ").title()
+        values = np.char.add(
+            np.char.add(np.char.add(label + " ", np.char.capitalize(rng.choice(WORDS, n))), " "),
+            row_index.astype(str),
+        )
+    suffix = np.char.add("-", row_index.astype(str))
+    if column.unique and not ("email" in name or "isbn" in name or "license" in name or "code" in name):
+        values = np.char.add(values, suffix)
+    if column.type_args and column.base_type in ("varchar", "character", "char"):
+        limit = column.type_args[0]
+        too_long = np.char.str_len(values) > limit
+        if column.unique and too_long.any():
+            # cutting the end off would cut off the row index that keeps the values apart: the start is shortened
+            room = max(limit - int(np.char.str_len(suffix).max()), 0)
+            values = np.where(too_long, np.char.add(values.astype(f"<U{room}") if room else "", suffix), values)
+        values = values.astype(f"<U{limit}")
+    return values
+
+
+def _date_values(column, n, rng, bounds, with_time):
+    days = rng.integers(0, _DATE_SPAN_DAYS, n)
+    dates = _BASE_DATE + days.astype("timedelta64[D]")
+    if with_time:
+        seconds = rng.integers(0, 24 * 3600, n).astype("timedelta64[s]")
+        return pd.Series(dates.astype("datetime64[s]") + seconds).dt.strftime("%Y-%m-%d %H:%M:%S").to_numpy()
+    return pd.Series(dates).dt.strftime("%Y-%m-%d").to_numpy()
+
+
+def _default_literal(column):
+    if column.default is None:
+        return None
+    default = column.default.strip()
+    if default.startswith("'") and default.endswith("'"):
+        return default[1:-1].replace("''", "'")
+    if re.match(r"^-?[\d.]+$", default) or default.upper() in ("TRUE", "FALSE"):
+        return default.lower()
+    # CURRENT_TIMESTAMP, now(), ... are evaluated by the generator instead
+    return None
+
+
+class SyntheticDataEngine:
+    def __init__(self, ddl_schema, engine, distributions=None, chunk_rows=SYNTHETIC_CHUNK_ROWS, seed=None):
+        self.schema = parse_ddl(ddl_schema)
+        self.levels, self.deferred = dependency_levels(self.schema)
+        self.engine = engine
+        self.distributions = distributions or {}
+        self.chunk_rows = chunk_rows
+        self.rng = np.random.default_rng(seed)
+        self.key_ranges = {}
+        self.sampled_keys = {}
+
+    def _integer_key(self, table):
+        if len(table.primary_key) != 1:
+            return None
+        column = table.columns.get(table.primary_key[0])
+        if column is None or not (column.is_serial or column.base_type in ("int", "integer", "bigint", "smallint", "int4", "int8")):
+            return None
+        return column.name
+
+    def _parent_keys(self, conn, table_name, column_name):
+        # integer keys we generated are a contiguous range, anything else is sampled from the database
+        key = (table_name, column_name)
+        if key in self.key_ranges:
+            return self.key_ranges[key]
+        if key not in self.sampled_keys:
+            rows = conn.execute(text(
+                f"SELECT DISTINCT {quote_identifier(column_name)} FROM {quote_identifier(table_name)} LIMIT :limit"
+            ), {"limit": MAX_SAMPLED_PARENT_KEYS}).fetchall()
+            self.sampled_keys[key] = np.array([row[0] for row in rows], dtype=object)
+        return self.sampled_keys[key]
+
+    def _foreign_key_values(self, conn, column, n, row_index, rng):
+        ref_table, ref_column = column.references
+        ref_column = ref_column or self.schema.tables[ref_table].primary_key[0]
+        keys = self._parent_keys(conn, ref_table, ref_column)
+        if isinstance(keys, tuple):
+            low, high = keys
+            if high < low:
+                return None
+            if column.unique:
+                return low + (row_index % (high - low + 1))
+            return rng.integers(low, high + 1, n)
+        if len(keys) == 0:
+            return None
+        if column.unique:
+            return keys[row_index % len(keys)]
+        return keys[rng.integers(0, len(keys), n)]
+
+    def generate_column(self, conn, table, column, n, row_index, rng, bounds):
+        distribution = self.distributions.get(table.name, {}).get(column.name, {})
+        column_bounds = bounds.get(column.name, {})
+        null_fraction = 0.0 if column.not_null else distribution.get("null_fraction", DEFAULT_NULL_FRACTION)
+        base_type = column.base_type
+
+        if (table.name, column.name) in self.deferred:
+            return np.full(n, None, dtype=object)
+        if column.name in table.primary_key and self._integer_key(table) == column.name:
+            return row_index
+        if column.references:
+            values = self._foreign_key_values(conn, column, n, row_index, rng)
+            if values is None:
+                return np.full(n, None, dtype=object)
+            return _with_nulls(values, null_fraction, rng)
+
+        if "values" in distribution and not column.unique:
+            weights = distribution.get("weights")
+            if weights:
+                weights = np.array(weights, dtype=float) / np.sum(weights)
+            values = rng.choice(np.array(distribution["values"], dtype=object), n, p=weights)
+        elif base_type in self.schema.enums or "values" in column_bounds:
+            values = rng.choice(np.array(self.schema.enums.get(base_type) or column_bounds["values"], dtype=object), n)
+        elif base_type in ("serial", "bigserial", "smallserial", "int", "integer", "bigint", "smallint", "int2", "int4", "int8"):
+            if column.unique:
+                values = int(column_bounds.get("min", 0)) + row_index
+            else:
+                values = _numeric_values(column, n, rng, column_bounds, distribution, is_integer=True)
+        elif base_type in ("numeric", "decimal", "real", "float", "float4", "float8", "double", "money"):
+            values = _numeric_values(column, n, rng, column_bounds, distribution, is_integer=False)
+        elif base_type in ("boolean", "bool"):
+            values = rng.random(n) < distribution.get("true_fraction", 0.5)
+        elif base_type == "date":
+            values = _date_values(column, n, rng, column_bounds, with_time=False)
+        elif base_type in ("timestamp", "timestamptz", "datetime"):
+            values = _date_values(column, n, rng, column_bounds, with_time=True)
+        elif base_type in ("time", "timetz"):
+            values = pd.Series(rng.integers(0, 24 * 3600, n)).map(
+                lambda seconds: f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+            ).to_numpy()
+        elif base_type in ("uuid",):
+            values = np.array([f"00000000-0000-4000-8000-{index:012d}" for index in row_index])
+        elif base_type in ("json", "jsonb"):
+            values = np.char.add(np.char.add('{"id": ', row_index.astype(str)), "}")
+        else:
+            values = _string_values(column, table.name, n, row_index, rng)
+
+        # nullable columns with a DEFAULT get the default instead of NULL
+        return _with_nulls(values, null_fraction, rng, fill=_default_literal(column))
+
+    def _composite_keys(self, table):
+        # multi-column primary keys and UNIQUE constraints, e.g. (student_id, course_id) of a bridge table;
+        # random foreign key values repeat pairs that single-column keys built from row_index never do
+        keys = [tuple(table.primary_key)] if len(table.primary_key) > 1 else []
+        keys += [tuple(columns) for columns in table.unique_constraints if len(columns) > 1 and tuple(columns) not in keys]
+        return [columns for columns in keys if all(column in table.columns for column in columns)]
+
+    def _drop_duplicate_keys(self, frame, seen_keys):
+        # COPY rejects the whole chunk on one repeated key, so rows repeating a composite key of this or an
+        # earlier chunk are dropped; keys with a NULL never collide in postgres
+        if not seen_keys:
+            return frame
+        key_rows = {
+            columns: (frame[list(columns)].isna().any(axis=1).to_numpy(), list(frame[list(columns)].itertuples(index=False, name=None)))
+            for columns in seen_keys
+        }
+        keep = np.ones(len(frame), dtype=bool)
+        for index in range(len(frame)):
+            keys = [(seen_keys[columns], rows[index]) for columns, (has_null, rows) in key_rows.items() if not has_null[index]]
+            if any(key in seen for seen, key in keys):
+                keep[index] = False
+                continue
+            for seen, key in keys:
+                seen.add(key)
+        return frame if keep.all() else frame[keep]
+
+    def _copy_chunk(self, cursor, table, columns, frame):
+        buffer = io.StringIO()
+        frame.to_csv(buffer, header=False, index=False, na_rep="")
+        buffer.seek(0)
+        column_sql = ", ".join(quote_identifier(column) for column in columns)
+        cursor.copy_expert(f"COPY {quote_identifier(table)} ({column_sql}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+    def _reserve_key_range(self, conn, table, rows):
+        key = self._integer_key(table)
+        if key is None:
+            return
+        current = conn.execute(text(
+            f"SELECT COALESCE(MAX({quote_identifier(key)}), 0) FROM {quote_identifier(table.name)}"
+        )).scalar()
+        self.key_ranges[(table.name, key)] = (int(current) + 1, int(current) + rows)
+
+    def _sync_sequence(self, cursor, table):
+        key = self._integer_key(table)
+        if key is None or not table.columns[key].is_serial:
+            return
+        cursor.execute(
+            f"SELECT setval(pg_get_serial_sequence(%s, %s), "
+            f"(SELECT COALESCE(MAX({quote_identifier(key)}), 1) FROM {quote_identifier(table.name)}))",
+            (quote_identifier(table.name), key),
+        )
+
+    def generate_table(self, conn, table_name, rows, on_progress=None):
+        table = self.schema.tables[table_name]
+        bounds = parse_check_bounds(table.checks)
+        columns = list(table.columns)
+        raw_connection = conn.connection
+        cursor = raw_connection.cursor()
+        start = time.perf_counter()
+        written = 0
+        dropped = 0
+        seen_keys = {columns: set() for columns in self._composite_keys(table)}
+        try:
+            # row_index doubles as the generated key and the suffix of unique values
+            first_index = self.key_ranges.get((table_name, self._integer_key(table)), (1, 0))[0]
+            for offset in range(0, rows, self.chunk_rows):
+                n = min(self.chunk_rows, rows - offset)
+                row_index = np.arange(first_index + offset, first_index + offset + n, dtype=np.int64)
+                frame = pd.DataFrame({
+                    column: self.generate_column(conn, table, table.columns[column], n, row_index, self.rng, bounds)
+                    for column in columns
+                })
+                kept = self._drop_duplicate_keys(frame, seen_keys)
+                dropped += n - len(kept)
+                self._copy_chunk(cursor, table_name, columns, kept)
+                written += len(kept)
+                del frame, kept
+                if on_progress:
+                    elapsed = time.perf_counter() - start
+                    on_progress(table_name, written, rows, written / elapsed if elapsed else 0.0)
+            self._sync_sequence(cursor, table)
+            raw_connection.commit()
+        except Exception:
+            raw_connection.rollback()
+            raise
+        finally:
+            cursor.close()
+        if dropped:
+            print(f"{table_name}: dropped {dropped:,} rows repeating a composite key")
+            # the generated keys now have gaps, children sample the keys that were written instead
+            self.key_ranges.pop((table_name, self._integer_key(table)), None)
+        return written
+
+    def fill_deferred_columns(self, conn):
+        # spread the cycle-breaking FK columns over the parent key range with one set-based UPDATE each
+        for table_name, column_name in self.deferred:
+            table = self.schema.tables[table_name]
+            column = table.columns.get(column_name)
+            pk = self._integer_key(table)
+            if column is None or column.references is None or pk is None:
+                continue
+            ref_table, ref_column = column.references
+            ref_column = ref_column or self.schema.tables[ref_table].primary_key[0]
+            key_range = self.key_ranges.get((ref_table, ref_column))
+            if key_range is None or key_range[1] < key_range[0]:
+                continue
+            low, high = key_range
+            conn.execute(text(
+                f"UPDATE {quote_identifier(table_name)} SET {quote_identifier(column_name)} = "
+                f":low + ({quote_identifier(pk)} * 7919) % :span"
+            ), {"low": low, "span": high - low + 1})
+        conn.commit()
+
+    def run(self, rows_per_table, on_progress=None):
+        # rows_per_table: an int for every table or {table: rows}
+        counts = {}
+        try:
+            with self.engine.connect() as conn:
+                for level in self.levels:
+                    for table_name in level:
+                        rows = rows_per_table.get(table_name, 0) if isinstance(rows_per_table, dict) else rows_per_table
+                        self._reserve_key_range(conn, self.schema.tables[table_name], rows)
+                        conn.commit()
+                        counts[table_name] = self.generate_table(conn, table_name, rows, on_progress)
+                if self.deferred:
+                    self.fill_deferred_columns(conn)
+        finally:
+            # every table is committed once it is written, a failed run has still changed the tables before it
+            read_cache.bump(self.engine, self.schema.tables)
+        return counts
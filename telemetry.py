@@ -0,0 +1,246 @@
+import contextvars
+import functools
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_DIR = os.getenv("METRICS_DIR", ".cache")
+TELEMETRY_LANGFUSE = os.getenv("TELEMETRY_LANGFUSE", "1") == "1"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# numeric span attributes that are also summed into counters
+COUNTED_ATTRIBUTES = (
+    "prompt_tokens", "output_tokens", "rows_returned", "rows_inserted", "rows_failed", "rows_updated",
+    "bytes_exported", "image_bytes",
+)
+METRIC_PREFIX = "talk_with_database"
+
+_current_trace = contextvars.ContextVar("telemetry_trace", default=None)
+_current_span = contextvars.ContextVar("telemetry_span", default=None)
+
+
+class Span:
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = dict(attributes)
+        self.start = time.perf_counter()
+        self.seconds = None
+        self.parent = _current_span.get()
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, **counts):
+        for key, value in counts.items():
+            self.attributes[key] = self.attributes.get(key, 0) + (value or 0)
+
+    def as_row(self):
+        return {
+            "stage": self.name,
+            "ms": round(self.seconds * 1000, 1) if self.seconds is not None else None,
+            "parent": self.parent.name if self.parent else None,
+            **self.attributes,
+        }
+
+
+class MetricsRegistry:
+    # latency histogram per stage and counters for tokens, rows and bytes; no network needed
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, span):
+        with self._lock:
+            histogram = self.histograms.setdefault(
+                span.name, {"count": 0, "sum": 0.0, "errors": 0, "buckets": [0] * len(LATENCY_BUCKETS)}
+            )
+            histogram["count"] += 1
+            histogram["sum"] += span.seconds
+            if "error" in span.attributes:
+                histogram["errors"] += 1
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if span.seconds <= bound:
+                    histogram["buckets"][index] += 1
+            for key in COUNTED_ATTRIBUTES:
+                value = span.attributes.get(key)
+                if isinstance(value, (int, float)) and value:
+                    counter = self.counters.setdefault(key, {})
+                    counter[span.name] = counter.get(span.name, 0) + value
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "stages": {
+                    name: {
+                        "count": histogram["count"],
+                        "errors": histogram["errors"],
+                        "seconds_sum": histogram["sum"],
+                        "seconds_mean": histogram["sum"] / histogram["count"],
+                        "buckets": dict(zip(map(str, LATENCY_BUCKETS), histogram["buckets"])),
+                    }
+                    for name, histogram in self.histograms.items()
+                },
+                "counters": {key: dict(values) for key, values in self.counters.items()},
+            }
+
+    def prometheus_text(self):
+        with self._lock:
+            lines = [
+                f"# HELP {METRIC_PREFIX}_stage_seconds Duration of each stage.",
+                f"# TYPE {METRIC_PREFIX}_stage_seconds histogram",
+            ]
+            for name, histogram in self.histograms.items():
+                label = _label(name)
+                for bound, count in zip(LATENCY_BUCKETS, histogram["buckets"]):
+                    lines.append(f'{METRIC_PREFIX}_stage_seconds_bucket{{stage="{label}",le="{bound}"}} {count}')
+                lines.append(f'{METRIC_PREFIX}_stage_seconds_bucket{{stage="{label}",le="+Inf"}} {histogram["count"]}')
+                lines.append(f'{METRIC_PREFIX}_stage_seconds_sum{{stage="{label}"}} {histogram["sum"]}')
+                lines.append(f'{METRIC_PREFIX}_stage_seconds_count{{stage="{label}"}} {histogram["count"]}')
+            lines.append(f"# TYPE {METRIC_PREFIX}_stage_errors_total counter")
+            for name, histogram in self.histograms.items():
+                lines.append(f'{METRIC_PREFIX}_stage_errors_total{{stage="{_label(name)}"}} {histogram["errors"]}')
+            for key, values in self.counters.items():
+                lines.append(f"# TYPE {METRIC_PREFIX}_{key}_total counter")
+                for name, value in values.items():
+                    lines.append(f'{METRIC_PREFIX}_{key}_total{{stage="{_label(name)}"}} {value}')
+            return "\n".join(lines) + "\n"
+
+    def write(self, directory=METRICS_DIR):
+        # metrics.prom can be scraped through a textfile collector, metrics.json is for people and scripts
+        os.makedirs(directory, exist_ok=True)
+        for file_name, content in (
+            ("metrics.prom", self.prometheus_text()),
+            ("metrics.json", json.dumps(self.to_dict(), indent=2)),
+        ):
+            path = os.path.join(directory, file_name)
+            with open(path + ".tmp", "w") as f:
+                f.write(content)
+            os.replace(path + ".tmp", path)
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+
+metrics = MetricsRegistry()
+
+
+def _langfuse_start(name, generation, model):
+    # Langfuse is set up together with the model; until then spans are only measured locally,
+    # which keeps langfuse out of the app's cold start
+    if not TELEMETRY_LANGFUSE or "langfuse" not in sys.modules:
+        return None, None
+    try:
+        from langfuse import get_client
+        client = get_client()
+        if generation:
+            manager = client.start_as_current_generation(name=name, model=model)
+        else:
+            manager = client.start_as_current_span(name=name)
+        return manager, manager.__enter__()
+    except Exception as e:
+        print(f"Langfuse span '{name}' not started: {e}")
+        return None, None
+
+
+def _langfuse_end(manager, observation, span, generation):
+    if manager is None:
+        return
+    try:
+        if generation:
+            observation.update(
+                metadata=span.attributes,
+                usage_details={
+                    "input": span.attributes.get("prompt_tokens", 0),
+                    "output": span.attributes.get("output_tokens", 0),
+                },
+            )
+        else:
+            observation.update(metadata=span.attributes)
+        manager.__exit__(None, None, None)
+    except Exception as e:
+        print(f"Langfuse span '{span.name}' not recorded: {e}")
+
+
+@contextmanager
+def span(name, generation=False, model=None, langfuse=True, **attributes):
+    # times a stage; attributes added on the span end up in Langfuse, the local metrics and the request trace
+    current = Span(name, attributes)
+    token = _current_span.set(current)
+    manager, observation = _langfuse_start(name, generation, model) if langfuse else (None, None)
+    try:
+        yield current
+    except Exception as e:
+        # BaseExceptions are control flow (st.rerun, cancelled tasks), not failures
+        current.attributes["error"] = type(e).__name__
+        raise
+    finally:
+        current.seconds = time.perf_counter() - current.start
+        _current_span.reset(token)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.append(current)
+        metrics.observe(current)
+        _langfuse_end(manager, observation, current, generation)
+
+
+def traced(name, **attributes):
+    # decorator form of span() for whole functions, sync or async
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with span(name, **attributes):
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name, **attributes):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record(**counts):
+    # adds counts (rows, bytes, ...) to the innermost open span
+    current = _current_span.get()
+    if current is not None:
+        current.add(**counts)
+
+
+def record_usage(response):
+    usage = getattr(response, "usage_metadata", None)
+    if usage is not None:
+        record(
+            prompt_tokens=getattr(usage, "prompt_token_count", 0) or 0,
+            output_tokens=getattr(usage, "candidates_token_count", 0) or 0,
+        )
+
+
+@contextmanager
+def trace_request(name, **attributes):
+    # collects every span of one user request, e.g. for the debug panel
+    spans = []
+    token = _current_trace.set(spans)
+    try:
+        with span(name, **attributes):
+            yield spans
+    finally:
+        _current_trace.reset(token)
+        write_metrics()
+
+
+def write_metrics():
+    try:
+        metrics.write()
+    except OSError as e:
+        print(f"Unable to write metrics: {e}")
+
+
+def slowest_spans(spans, limit=10):
+    return [s.as_row() for s in sorted(spans, key=lambda s: s.seconds or 0, reverse=True)[:limit]]
@@ -1,13 +1,28 @@
-import hashlib
 from psycopg2 import IntegrityError
+import pandas as pd
 import streamlit as st
-from databse_operations import add_data_to_database, check_if_possible_update, create_database, get_schema_from_db, select_table
-import io, zipfile
+from databse_operations import add_data_to_database, apply_edit_plan, count_rows, create_database, describe_tables_for_edits, get_catalog, get_schema_from_db, get_session_schema, select_table
+from session_database import with_role
+from schema_catalog import compute_ddl_hash
+from generation_scheduler import generate_by_dependency_levels, generate_to_targets, regenerate_failed_tables
+from synthetic_data import SyntheticDataEngine
+from streaming_ingestion import stream_into_database
+from data_export import EXPORT_FORMATS, export_tables
+from dataset_snapshots import delete_snapshot, list_snapshots, read_manifest, restore_snapshot, save_snapshot
+from telemetry import record, span, trace_request
+import os
+import time
+
+
+@st.cache_resource
+def read_css(file_name):
+    # read once per process, not on every rerun
+    with open(file_name) as f:
+        return f.read()
 
 
 def load_css(file_name):
-    with open(file_name) as f:
-        st.markdown(f"<style>{f.read()}</style>", unsafe_allow_html=True)
+    st.markdown(f"<style>{read_css(file_name)}</style>", unsafe_allow_html=True)
 
 
 def show_generation_prompt():
@@ -32,7 +47,14 @@ def show_file_uploader():
     return None
 
 
-def show_advanced_parameters():
+GENERATION_MODES = [
+    "Single request", "Single request (streaming)", "Per table (parallel)", "Paged (target rows per table)",
+    "Local engine (high volume)",
+]
+PAGE_ROWS = 200
+
+
+def show_advanced_parameters(tables):
     # advanced parameters
     st.subheader("Advanced Parameters")
     col3, col4 = st.columns([0.7, 0.3])
@@ -42,62 +64,121 @@ def show_advanced_parameters():
     with col4:
         st.text("Max Tokens")
         max_tokens = st.number_input("Max Tokens", min_value=1, value=10000, step=1, label_visibility="collapsed")
+    st.text("Generation Mode")
+    generation_mode = st.radio("Generation Mode", GENERATION_MODES, horizontal=True, label_visibility="collapsed")
+    mode_options = None
+    if generation_mode == "Paged (target rows per table)":
+        col_rows, col_page = st.columns([0.7, 0.3])
+        with col_rows:
+            st.text("Target rows per table")
+            targets = st.data_editor(
+                pd.DataFrame({"table": tables, "target rows": [1000] * len(tables)}),
+                column_config={"table": st.column_config.TextColumn(disabled=True),
+                               "target rows": st.column_config.NumberColumn(min_value=0, step=100)},
+                hide_index=True,
+                key="target_rows",
+            )
+        with col_page:
+            st.text("Rows per request")
+            page_rows = st.number_input("Rows per request", min_value=1, value=PAGE_ROWS, step=50, label_visibility="collapsed")
+        mode_options = {
+            "targets": {row["table"]: int(row["target rows"] or 0) for row in targets.to_dict("records")},
+            "page_rows": int(page_rows),
+        }
+    elif generation_mode == "Local engine (high volume)":
+        col_rows, col_distributions = st.columns([0.3, 0.7])
+        with col_rows:
+            st.text("Rows per table")
+            rows_per_table = st.number_input("Rows per table", min_value=1, value=10000, step=1000, label_visibility="collapsed")
+        with col_distributions:
+            st.text("")
+            suggest_distributions = st.checkbox("Ask the model once for column distributions")
+        mode_options = {"rows_per_table": int(rows_per_table), "suggest_distributions": suggest_distributions}
     st.markdown("")
     generate_clicked_state = st.button("Generate", type="secondary")
-    return temperature, max_tokens, generate_clicked_state
+    return temperature, max_tokens, generation_mode, mode_options, generate_clicked_state
 
 
 
 def show_save_buttons(session_state):
-    col_save1, col_save2, _ = st.columns([0.2, 0.2, 0.6])
+    col_format, col_save, col_download, _ = st.columns([0.2, 0.2, 0.2, 0.4])
 
-    # ================= CSV =================
-    with col_save1:
-        clicked_csv = st.button("Save to CSV", type="secondary", icon=":material/save:", width='stretch')
+    with col_format:
+        export_format = st.selectbox("Export format", list(EXPORT_FORMATS), label_visibility="collapsed")
+    with col_save:
+        clicked_export = st.button("Export", type="secondary", icon=":material/save:", width='stretch')
 
-        if clicked_csv:
-            all_tables = get_schema_from_db(session_state)
-            if not all_tables:
-                st.error("No tables found in the database. Please add any data first.")
-            else:
-                tables_dict = {}
-                for table in all_tables:
-                    df = select_table(table)
-                    if df is not None:
-                        tables_dict[table] = df
-
-                output = io.StringIO()
-                for table_name, df in tables_dict.items():
-                    output.write(f"=== TABLE: {table_name} ===\n")
-                    df.to_csv(output, index=False)
-                    output.write("\n\n")
-            
-                st.download_button(label="Click to download CSV", data=output.getvalue().encode("utf-8"), file_name="all_tables.csv",
-                                   mime="text/csv", key="download_all_tables_csv", use_container_width=True)
-
-    # ================= ZIP =================
-    with col_save2:
-        clicked_zip = st.button("Save to ZIP", type="secondary", icon=":material/save:", width='stretch')
-
-        if clicked_zip:
-            all_tables = get_schema_from_db(session_state)
-            if not all_tables:
-                st.error("No tables found in the database. Please add any data first.")
-
-            tables_dict = {}
-            for table in all_tables:
-                df = select_table(table)
-                if df is not None:
-                    tables_dict[table] = df
-
-            zip_buffer = io.BytesIO()
-            with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
-                for table_name, df in tables_dict.items():
-                    csv_bytes = df.to_csv(index=False).encode("utf-8")
-                    zip_file.writestr(f"{table_name}.csv", csv_bytes)
+    if clicked_export:
+        all_tables = get_schema_from_db(session_state)
+        if not all_tables:
+            st.error("No tables found in the database. Please add any data first.")
+            return
 
-            st.download_button("Download ZIP", data=zip_buffer.getvalue(), file_name="all_tables.zip", 
-                               type="secondary", icon=":material/save:", width='stretch')
+        # remove the previous export of this session before writing a new one
+        previous_export = session_state.get("export_path")
+        if previous_export and os.path.exists(previous_export):
+            os.remove(previous_export)
+        with st.spinner("Exporting tables..."), span("export", export_format=export_format, tables=len(all_tables)):
+            session_state.export_path = export_tables(with_role(session_state.engine, "bulk"), all_tables, export_format)
+            record(bytes_exported=os.path.getsize(session_state.export_path))
+        session_state.export_format = export_format
+
+    export_path = session_state.get("export_path")
+    if export_path and os.path.exists(export_path):
+        file_name, mime = EXPORT_FORMATS[session_state.export_format]
+        with col_download, open(export_path, "rb") as export_file:
+            st.download_button(f"Download {session_state.export_format}", data=export_file, file_name=file_name,
+                               mime=mime, type="secondary", icon=":material/download:", width='stretch')
+
+
+def describe_snapshot(snapshot):
+    parameters = snapshot["parameters"]
+    details = [snapshot["created_at"].replace("T", " "), f"{snapshot['rows']:,} rows", f"{snapshot['bytes'] / 1024:,.0f} KB"]
+    if parameters.get("mode"):
+        details.append(parameters["mode"])
+    return (snapshot["label"] + ": " if snapshot["label"] else "") + ", ".join(details)
+
+
+def show_snapshots(session_state):
+    # snapshots of the current DDL: the generated data is saved once and reloaded without calling the model
+    if session_state.engine is None or not session_state.get("last_ddl_hash"):
+        return
+    ddl_hash = session_state.last_ddl_hash
+    with st.expander("Snapshots"):
+        col_label, col_save = st.columns([0.7, 0.3])
+        with col_label:
+            label = st.text_input("Snapshot label", placeholder="Snapshot label (optional)", label_visibility="collapsed")
+        with col_save:
+            clicked_save = st.button("Save snapshot", icon=":material/inventory_2:", width='stretch')
+        if clicked_save:
+            all_tables = get_schema_from_db(session_state)
+            with st.spinner("Saving snapshot..."), span("snapshot.save", tables=len(all_tables)):
+                path = save_snapshot(
+                    with_role(session_state.engine, "bulk"), ddl_hash, all_tables,
+                    parameters=session_state.get("generation_parameters"), label=label,
+                )
+            st.success(f"Snapshot saved ({describe_snapshot(read_manifest(path))}).")
+
+        snapshots = list_snapshots(ddl_hash)
+        if not snapshots:
+            st.caption("No snapshots of this schema yet.")
+            return
+        col_select, col_restore, col_delete = st.columns([0.6, 0.2, 0.2])
+        with col_select:
+            snapshot = st.selectbox("Snapshot", snapshots, format_func=describe_snapshot, label_visibility="collapsed")
+        with col_restore:
+            clicked_restore = st.button("Restore", icon=":material/restore:", width='stretch')
+        with col_delete:
+            clicked_delete = st.button("Delete", icon=":material/delete:", width='stretch')
+        if clicked_restore:
+            start = time.perf_counter()
+            with st.spinner("Restoring snapshot..."), span("snapshot.restore", tables=len(snapshot["tables"])) as restore:
+                rows = restore_snapshot(with_role(session_state.engine, "bulk"), snapshot["path"], ddl_hash)
+                restore.set(rows_inserted=sum(rows.values()))
+            st.success(f"Restored {sum(rows.values()):,} rows into {len(rows)} tables in {time.perf_counter() - start:.1f}s.")
+        if clicked_delete:
+            delete_snapshot(snapshot["path"])
+            st.rerun()
 
 
 def show_dropdown_list(tables):
@@ -117,12 +198,14 @@ def show_dropdown_list(tables):
     return selected_data
 
 
-def show_table(table):
+def show_table(table, row_count=None):
     st.dataframe(table, width='stretch', hide_index=True)
+    if row_count is not None:
+        st.caption(f"{row_count} rows")
 
 
 def show_chat_interface():
-    st.text("Specify which TABLE to update, the ROW ID to edit, and the NEW VALUES for the columns.")
+    st.text("Specify which TABLE to update, the ROWS to edit (IDs, ID ranges or conditions) and the NEW VALUES. Several edits can be listed.")
     col7, col8 = st.columns([0.88, 0.12])
     with col7:
         quick_instructions = st.text_input("Quick Instructions", placeholder="Enter quick edit instructions...", label_visibility="collapsed")
@@ -137,6 +220,15 @@ def show_chat_interface():
 
 MAX_RETRIES = 3 
 
+def describe_failures(report):
+    # one entry per table and violated constraint
+    return "; ".join(
+        f"{table}: {reason} ({rows} rows)"
+        for table, reasons in report.failed_constraints().items()
+        for reason, rows in reasons.items()
+    )
+
+
 def safe_generate_and_add(model, ddl_schema, user_generation_prompt, temperature, max_tokens):
     for attempt in range(MAX_RETRIES):
         st.info(f"(Generating data, attempt: {attempt + 1}/{MAX_RETRIES})...")
@@ -154,11 +246,30 @@ def safe_generate_and_add(model, ddl_schema, user_generation_prompt, temperature
             return
 
         try:
-            add_data_to_database(response, st.session_state) 
+            report = add_data_to_database(response, st.session_state)
+            if report is not None:
+                st.caption(" | ".join(report.summary()))
+            # rejected rows are lost, the rest stays: the next attempts only ask for the failing tables again
+            for retry in range(attempt + 1, MAX_RETRIES):
+                if report is None or not report.failures:
+                    break
+                st.warning(f"{report.failed_rows} rows were rejected: {describe_failures(report)}")
+                st.info(f"(Regenerating {', '.join(report.failed_tables())}, attempt: {retry + 1}/{MAX_RETRIES})...")
+                retry_report = regenerate_failed_tables(
+                    model, ddl_schema, st.session_state, report,
+                    prompt=user_generation_prompt, temperature=temperature, max_tokens=max_tokens,
+                )
+                if retry_report is None:
+                    break
+                st.caption(" | ".join(retry_report.summary()))
+                report = retry_report
+            if report is not None and report.failures:
+                st.warning(f"{report.failed_rows} rows were skipped: {describe_failures(report)}")
             st.success("Data successfully generated and added to the database.")
             return
 
         except IntegrityError as e:
+            # the whole transaction failed, nothing was kept
             print(f"Error {attempt + 1}: {e.orig}")
             st.warning(f"Error has occured while inserting data: {e.orig}. Retrying...")
             continue 
@@ -170,7 +281,113 @@ def safe_generate_and_add(model, ddl_schema, user_generation_prompt, temperature
     st.error(f"Generating data failed after {MAX_RETRIES} attempts due to repeated integrity errors.")
 
 
-def view_data_generation_foo(model):
+def parallel_generate_and_add(model, ddl_schema, user_generation_prompt, temperature, max_tokens):
+    st.info("(Generating data table by table, following foreign key dependencies)...")
+    try:
+        generate_by_dependency_levels(
+            model,
+            ddl_schema,
+            st.session_state,
+            prompt=user_generation_prompt,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            on_progress=st.write,
+        )
+        st.success("Data successfully generated and added to the database.")
+    except Exception as e:
+        st.error(f"Unexpected error has occured {e}")
+        print(f"Unexpected error:  {e}")
+
+
+def paged_generate_and_add(model, ddl_schema, user_generation_prompt, temperature, max_tokens, targets, page_rows):
+    st.info(f"(Generating up to {page_rows} rows per request until every table reaches its target)...")
+    progress_bar = st.progress(0.0)
+    status = st.empty()
+    total = sum(targets.values())
+    rows_so_far = {}
+
+    def on_progress(table_name, rows, target, rows_per_second, eta_seconds):
+        rows_so_far[table_name] = min(rows, target)
+        progress_bar.progress(min(sum(rows_so_far.values()) / total, 1.0) if total else 1.0)
+        eta = f"~{eta_seconds:,.0f}s left" if eta_seconds != float("inf") else "estimating..."
+        status.text(f"{table_name}: {rows:,}/{target:,} rows ({rows_per_second:,.1f} rows/s, {eta})")
+
+    try:
+        rows, report = generate_to_targets(
+            model, ddl_schema, st.session_state, targets, page_rows,
+            prompt=user_generation_prompt, temperature=temperature, max_tokens=max_tokens, on_progress=on_progress,
+        )
+        short = {table: count for table, count in rows.items() if count < targets[table]}
+        if short:
+            st.warning("Stopped below the target: " + ", ".join(
+                f"{table} ({count:,}/{targets[table]:,})" for table, count in short.items()
+            ))
+        else:
+            st.success(f"Every table reached its target ({sum(rows.values()):,} rows).")
+        if report.failures:
+            st.warning(f"{report.failed_rows} rows were skipped: {describe_failures(report)}")
+    except Exception as e:
+        st.error(f"Unexpected error has occured {e}")
+        print(f"Unexpected error:  {e}")
+
+
+def streaming_generate_and_add(model, ddl_schema, user_generation_prompt, temperature, max_tokens):
+    st.info("(Streaming data into the database as it is generated)...")
+    status = st.empty()
+
+    def on_progress(rows_by_table, timings):
+        lines = [f"{table}: {rows:,} rows" for table, rows in rows_by_table.items()]
+        first_row = timings["first_row_seconds"]
+        lines.append(f"{timings['seconds']:.1f}s elapsed" + (f", first row after {first_row:.1f}s" if first_row is not None else ""))
+        status.text("\n".join(lines))
+
+    try:
+        chunks = model.stream_database(
+            ddl_schema=ddl_schema,
+            prompt=user_generation_prompt,
+            temperature=temperature,
+            max_output_tokens=max_tokens,
+        )
+        report, timings = stream_into_database(
+            chunks, with_role(st.session_state.engine, "bulk"), catalog=get_catalog(st.session_state), on_progress=on_progress
+        )
+        on_progress({table: stats["rows"] for table, stats in report.tables.items()}, timings)
+        st.success("Data successfully generated and added to the database.")
+        if timings["truncated"]:
+            st.warning("The response was cut off by the token limit, its last statement was not inserted. "
+                       "Raise Max Tokens to generate more rows.")
+        if report.failures:
+            st.warning(f"{report.failed_rows} rows were skipped: " + "; ".join(
+                f"{failure['table']}: {failure['error']}" for failure in report.failures[:5]
+            ))
+    except Exception as e:
+        st.error(f"Unexpected error has occured {e}")
+        print(f"Unexpected error:  {e}")
+
+
+def local_generate_and_add(model, ddl_schema, rows_per_table, suggest_distributions):
+    distributions = {}
+    if suggest_distributions:
+        with st.spinner("Asking the model for column distributions..."):
+            distributions = model.suggest_column_distributions(ddl_schema)
+
+    progress_bar = st.progress(0.0)
+    status = st.empty()
+
+    def on_progress(table_name, written, total, rows_per_second):
+        progress_bar.progress(written / total if total else 1.0)
+        status.text(f"{table_name}: {written:,}/{total:,} rows ({rows_per_second:,.0f} rows/s)")
+
+    try:
+        engine = SyntheticDataEngine(ddl_schema, with_role(st.session_state.engine, "bulk"), distributions=distributions)
+        counts = engine.run(rows_per_table, on_progress=on_progress)
+        st.success(f"Generated {sum(counts.values()):,} rows across {len(counts)} tables.")
+    except Exception as e:
+        st.error(f"Unexpected error has occured {e}")
+        print(f"Unexpected error:  {e}")
+
+
+def view_data_generation_foo(get_model):
     load_css("styles.css")
 
     st.set_page_config(layout="wide", page_title="Data Assistant Prototype")
@@ -186,45 +403,71 @@ def view_data_generation_foo(model):
 
     if ddl_schema:
         # hash of current DDL script to detect changes
-        current_hash = hashlib.sha256(ddl_schema.encode('utf-8')).hexdigest()
+        current_hash = compute_ddl_hash(ddl_schema)
         if current_hash != st.session_state.last_ddl_hash:
             try:
-                st.session_state.update(create_database(ddl_schema))
+                st.session_state.update(create_database(ddl_schema, session_schema=get_session_schema(st.session_state)))
                 st.session_state.last_ddl_hash = current_hash
+                if st.session_state.schema_changes:
+                    with st.sidebar.expander("Schema changes", expanded=True):
+                        st.markdown("\n".join(f"- {line}" for line in st.session_state.schema_changes))
                 st.session_state.file_uploader_key += 1
             except Exception as e:
                 st.sidebar.error(f"Database creation failed: {e}")
 
     tables = get_schema_from_db(st.session_state)
-    temperature, max_tokens, generate_clicked_state= show_advanced_parameters()
+    temperature, max_tokens, generation_mode, mode_options, generate_clicked_state = show_advanced_parameters(tables)
     show_save_buttons(st.session_state)
+    show_snapshots(st.session_state)
 
     if generate_clicked_state:
-        if ddl_schema:
-            safe_generate_and_add(
-                model,
-                ddl_schema=ddl_schema,
-                user_generation_prompt=user_generation_prompt,
-                temperature=temperature,
-                max_tokens=max_tokens
-            )
+        # saved with snapshots of the generated data
+        st.session_state.generation_parameters = {
+            "mode": generation_mode, "prompt": user_generation_prompt, "temperature": temperature,
+            "max_tokens": int(max_tokens), **(mode_options or {}),
+        }
+        if ddl_schema and generation_mode == "Local engine (high volume)":
+            with trace_request("generation.request", mode="local") as spans:
+                st.session_state.last_trace = spans
+                local_generate_and_add(get_model(), ddl_schema, **mode_options)
+        elif ddl_schema:
+            generate_and_add = {
+                "Single request (streaming)": streaming_generate_and_add,
+                "Per table (parallel)": parallel_generate_and_add,
+                "Paged (target rows per table)": paged_generate_and_add,
+            }.get(generation_mode, safe_generate_and_add)
+            with trace_request("generation.request", mode=generation_mode) as spans:
+                st.session_state.last_trace = spans
+                generate_and_add(
+                    get_model(),
+                    ddl_schema=ddl_schema,
+                    user_generation_prompt=user_generation_prompt,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    **(mode_options or {}),
+                )
         else:
             st.warning("Please upload a DDL schema file before generating data.")
 
     # data preview
     selected_table = show_dropdown_list(tables)
-    table_data = select_table(selected_table)
-    show_table(table_data)
+    table_data = select_table(selected_table) if tables else None
+    show_table(table_data, count_rows(selected_table) if tables else None)
 
     # edit
     user_edit_prompt = show_chat_interface()
     if user_edit_prompt:
-        extracted_info = model.extract_important_info_from_edit_prompt(user_edit_prompt)
-        st.info(f"Extracted Info: {extracted_info}")
+        edit_plan = get_model().extract_edit_plan(user_edit_prompt, describe_tables_for_edits(st.session_state))
 
-        if isinstance(extracted_info, tuple):
-            if_possible, update_result = check_if_possible_update(st.session_state, extracted_info[0], extracted_info[1], extracted_info[2])
+        if isinstance(edit_plan, dict):
+            with st.expander("Edit plan"):
+                st.json(edit_plan)
+            if_possible, update_result = apply_edit_plan(st.session_state, edit_plan)
             if if_possible:
-                st.success(update_result)
+                total_rows = sum(edit["rows"] for edit in update_result["affected"])
+                st.success(f"Updated {total_rows} rows in {update_result['seconds'] * 1000:.0f} ms.")
+                st.dataframe(update_result["affected"], hide_index=True)
             else:
-                st.error(update_result)
\ No newline at end of file
+                st.error(update_result)
+        else:
+            st.info(edit_plan)
\ No newline at end of file
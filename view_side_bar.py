@@ -1,4 +1,5 @@
 import streamlit as st
+from telemetry import slowest_spans
 
 
 def show_side_bar():
@@ -11,4 +12,8 @@ def show_side_bar():
         if st.sidebar.button("Talk to your data", icon=":material/chat:"):
             st.session_state.page = "Talk to your data"
         st.markdown("---")
+        last_trace = st.session_state.get("last_trace")
+        if last_trace:
+            with st.expander("Debug: slowest stages of the last request"):
+                st.dataframe(slowest_spans(last_trace), hide_index=True)
     return st.session_state.page
\ No newline at end of file
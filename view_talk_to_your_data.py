@@ -1,71 +1,144 @@
 import streamlit as st
-import pandas as pd
 import subprocess
-import seaborn as sns
-import matplotlib.pyplot as plt
-from databse_operations import execute_given_sql_statement
+from sqlalchemy.exc import SQLAlchemyError
+from databse_operations import QueryTooExpensive, execute_given_sql_statement, fetch_result_page
+from answer_cache import answer_cache
+from conversation_context import ContextBuilder
+from plot_renderer import PLOT_FORMAT, PlotRenderError, plot_renderer
+from message_store import MESSAGE_EXPANDED_COUNT, MessageStore
+from telemetry import record, span, trace_request
 
 def show_talk_to_your_data():
     st.title("Talk to your data")
+    stats = answer_cache.stats()
+    st.caption(f"Answer cache: {stats['hits']} hits / {stats['misses']} misses ({stats['hit_ratio']:.0%} hit ratio)")
     st.markdown("---")
 
-def execute_seaborn_code(code, df, local_vars=None):
-    if local_vars is None:
-        local_vars = {}
-    
-    local_vars.update({
-        "pd": pd,
-        "sns": sns,
-        "plt": plt,
-        "df": df
-    })
-    exec(code, {}, local_vars)
-    
-    fig = plt.gcf()
-    return fig
-
-
-def view_talk_to_your_data_foo(model):
+def execute_seaborn_code(code, df, image_format=PLOT_FORMAT):
+    # rendered in a worker process, only the image bytes come back
+    with span("plot.render", image_format=image_format):
+        image = plot_renderer.render(code, df, image_format)
+        record(image_bytes=len(image))
+    return image
+
+
+def show_plot(message, store):
+    image = store.payload(message)
+    if message["image_format"] == "svg":
+        st.image(image.decode("utf-8"))
+    else:
+        st.image(image)
+
+
+def show_result_pages(message, message_index, store):
+    st.table(store.payload(message))
+    col_prev, col_page, col_next, _ = st.columns([0.12, 0.12, 0.12, 0.64])
+    page = message["page"]
+    with col_prev:
+        previous_clicked = st.button("Previous", key=f"previous_page_{message_index}", disabled=page == 0)
+    with col_page:
+        st.caption(f"Page {page + 1}")
+    with col_next:
+        next_clicked = st.button("Next", key=f"next_page_{message_index}", disabled=len(message["page_tokens"]) <= page + 1)
+
+    # later pages are only fetched when asked for
+    if previous_clicked or next_clicked:
+        page = page - 1 if previous_clicked else page + 1
+        df, next_token = fetch_result_page(message["sql"], message["page_tokens"][page])
+        if next_token is not None and len(message["page_tokens"]) == page + 1:
+            message["page_tokens"].append(next_token)
+        message["page"] = page
+        store.set_payload(message, df)
+        st.rerun()
+
+
+def result_summary(message):
+    if message["type"] == "DATA":
+        return f"{message.get('rows', 0)} rows x {len(message.get('columns', []))} columns"
+    return "Plot"
+
+
+def view_talk_to_your_data_foo(get_model):
     st.set_page_config(layout="wide")
     show_talk_to_your_data()
     if "messages" not in st.session_state:
-        st.session_state.messages = []
+        st.session_state.messages = MessageStore()
+    if "context_builder" not in st.session_state:
+        st.session_state.context_builder = ContextBuilder()
 
-    for message in st.session_state.messages:
+    store = st.session_state.messages
+    # older results are collapsed and only loaded from the store when opened
+    expanded_from = len(store) - MESSAGE_EXPANDED_COUNT
+    for message_index, message in enumerate(store):
         with st.chat_message(message["role"]):
+            st.write(message["text"])
             if message["type"] == "TEXT":
-                st.write(message["text"])
-            elif message["type"] == "DATA":
-                st.write(message["text"])
+                continue
+            if message_index < expanded_from and not st.toggle(
+                f"Show result ({result_summary(message)})", key=f"show_result_{message['id']}"
+            ):
+                continue
+            if message["type"] == "DATA":
                 st.code(message["sql"])
-                st.table(message["content"])
+                if message.get("warning"):
+                    st.warning(message["warning"])
+                show_result_pages(message, message_index, store)
             elif message["type"] == "PLOT":
-                st.pyplot(message["plot_figure"])
+                show_plot(message, store)
 
     prompt = st.chat_input("Ask a question about your data...")
 
+    if prompt and st.session_state.get("engine") is None:
+        st.warning("Upload a DDL schema on the Data Generation page first.")
+        return
+
     if prompt:
-        st.session_state.messages.append({"role": "user", "type": "TEXT", "text": prompt})
-        safety_categories = model.check_prompt_safety(prompt)
-    
-        if safety_categories:
-            print("SAFETY_PROBLEM_________________________________")
-            st.error(f"Your prompt is blocked due to: {safety_categories}")
-            return  
-        print("NO SAFETY PROBLEMS")
-        result_type, description, sql_query, python_code = model.generate_answer(st.session_state.ddl_schema, prompt, st.session_state.messages)
-        
-        if result_type == 'DATA' and sql_query:
-            results = execute_given_sql_statement(sql_query)
-            results_message = {"role": "assistant", "type": "DATA", "sql":sql_query, "content": results, "text": description}
-            st.session_state.messages.append(results_message)
-        elif result_type == 'PLOT' and sql_query and python_code:
-            df = execute_given_sql_statement(sql_query)
-            fig = execute_seaborn_code(python_code, df)
-            results_message = {"role": "assistant", "type": "PLOT", "plot_figure": fig}
-            st.session_state.messages.append(results_message)
-        else:
-            results_message = {"role": "assistant", "type": "TEXT", "text": description}
-            st.error("Your prompt is not correct. {description}")
-            st.session_state.messages.append(results_message)
+        # every stage of the request is timed, the slowest ones are shown in the sidebar
+        with trace_request("talk.request") as spans:
+            st.session_state.last_trace = spans
+            st.session_state.messages.append({"role": "user", "type": "TEXT", "text": prompt})
+            # the current prompt is passed separately, only earlier turns go into the context
+            context = st.session_state.context_builder.build(st.session_state.messages[:-1])
+            # safety check and answer run concurrently, the answer is cancelled if the prompt is blocked
+            # runs on the model's long-lived event loop, its async client is bound to that loop
+            model = get_model()
+            previous_questions = [message["text"] for message in st.session_state.messages[:-1] if message["role"] == "user"]
+            safety_categories, answer = model.run(model.answer_safely(
+                st.session_state.ddl_schema, prompt, context, ddl_hash=st.session_state.get("last_ddl_hash"),
+                previous_question=previous_questions[-1] if previous_questions else None,
+            ))
+
+            if safety_categories:
+                print("SAFETY_PROBLEM_________________________________")
+                st.error(f"Your prompt is blocked due to: {safety_categories}")
+                return
+            print("NO SAFETY PROBLEMS")
+            result_type, description, sql_query, python_code = answer
+
+            try:
+                if result_type == 'DATA' and sql_query:
+                    results, next_token = fetch_result_page(sql_query)
+                    results_message = {"role": "assistant", "type": "DATA", "sql":sql_query, "content": results, "text": description,
+                                       "page": 0, "page_tokens": [None] + ([next_token] if next_token else []),
+                                       "warning": results.attrs.get("warning")}
+                    st.session_state.messages.append(results_message)
+                elif result_type == 'PLOT' and sql_query and python_code:
+                    df = execute_given_sql_statement(sql_query)
+                    if df.attrs.get("truncated"):
+                        st.warning("The plot only uses the first rows of the result, the row limit was reached.")
+                    image = execute_seaborn_code(python_code, df)
+                    results_message = {"role": "assistant", "type": "PLOT", "image": image, "image_format": PLOT_FORMAT,
+                                       "sql": sql_query, "text": description}
+                    st.session_state.messages.append(results_message)
+                else:
+                    results_message = {"role": "assistant", "type": "TEXT", "text": description}
+                    st.error("Your prompt is not correct. {description}")
+                    st.session_state.messages.append(results_message)
+            except PlotRenderError as e:
+                st.session_state.messages.append({"role": "assistant", "type": "TEXT", "text": f"The plot could not be rendered: {e}"})
+            except QueryTooExpensive as e:
+                st.session_state.messages.append({"role": "assistant", "type": "TEXT", "text": str(e)})
+            except SQLAlchemyError as e:
+                # statement timeout, invalid SQL, ...
+                st.session_state.messages.append({"role": "assistant", "type": "TEXT", "text": f"The query failed: {e.orig or e}"})
         st.rerun()
\ No newline at end of file